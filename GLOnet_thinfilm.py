@@ -1,19 +1,33 @@
 import matplotlib.pyplot as plt
+import os
+import random
+import threading
 import torch
 import numpy as np
-import pandas as pd
 import math
 import torch.nn as nn
 import torch.nn.functional as F
-from scipy.interpolate import UnivariateSpline
 from TMM import *
+from sensor import SpectralResponse
 from tqdm import tqdm
 from net import Generator, ResGenerator
+from utils import save_checkpoint_atomic, load_checkpoint
+from history import HistoryRecorder
+from profiling import PhaseProfiler, NullProfiler
+from precision import PrecisionPolicy
+from tiling import TMM_solver_tiled
+from cache import DesignCache
+from adaptive_grid import AdaptiveGrid
+from controller import TrainingController
+from quadrature import hemispherical_reflection, band_integral
 
 class GLOnet():
     def __init__(self, params):
         # GPU 
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        # dtypes of material databases and TMM solves, float32 / complex64 unless params.precision says otherwise
+        self.precision = getattr(params, 'precision', None) or PrecisionPolicy.training()
+        self.dtype = self.precision.real_dtype
         self.generator = self._init_generator(params)   
         self.optimizer = self._init_optimizer(params)
         self.scheduler = self._init_scheduler(params)
@@ -26,6 +40,12 @@ class GLOnet():
         self.alpha_sup = params.alpha_sup
         self.iter0 = 0
         self.alpha = 0.1
+        # plateau driven alpha schedule, lr and early termination, params.controller is True or a dict of TrainingController options
+        options = getattr(params, 'controller', None)
+        self.controller = TrainingController(**(options if isinstance(options, dict) else {})) if options else None
+        self.alpha_offset = 0.
+        self.stop_reason = None
+        self.stop_iter = None
     
         # simulation parameters
         self.user_define = params.user_define
@@ -36,22 +56,64 @@ class GLOnet():
         self._init_simulation_parameters(params)
         self.n_bot = self.to_cuda_if_available(params.n_bot)  # number of frequencies or 1
         self.n_top = self.to_cuda_if_available(params.n_top)  # number of frequencies or 1
-        self.k = self.to_cuda_if_available(params.k)  # number of frequencies
-        self.theta = self.to_cuda_if_available(params.theta) # number of angles       
+        self.k = self.to_cuda_if_available(params.k).type(self.dtype)  # number of frequencies
+        self.theta = self.to_cuda_if_available(params.theta).type(self.dtype) # number of angles       
         self.pol = params.pol # str of pol
+        # quadrature weights of the grids (quadrature.wavelength_grid / angle_grid), trapezoid rule / plain means if None
+        k_weights = getattr(params, 'k_weights', None) # number of frequencies, over wavelength
+        theta_weights = getattr(params, 'theta_weights', None) # number of angles
+        self.k_weights = None if k_weights is None else self.to_cuda_if_available(k_weights).double()
+        self.theta_weights = None if theta_weights is None else self.to_cuda_if_available(theta_weights).double()
+        self.reduction = getattr(params, 'reduction', 'sequential') # 'sequential' or 'tree' layer product
+        self.backend = getattr(params, 'backend', 'matmul') # 'matmul', 'fused', 'adjoint' or 'compiled' TMM kernels
+        self.tmm_context = get_solver_context(self.n_bot, self.n_top, self.k, self.theta, self.pol, self.precision)
         self.target_reflection = self.to_cuda_if_available(params.target_reflection) if not self.sensor else None
         # 1 x number of frequencies x number of angles x (number of pol or 1)
+        # weighted multi-output objective, output name -> (weight, target), e.g. {'reflection': (1., R), 'transmission': (0.5, T)}
+        self.objectives = {name: (weight, self.to_cuda_if_available(target))
+                           for name, (weight, target) in (getattr(params, 'objectives', None) or {}).items()}
+        # manufacturing tolerance: penalty robust_coeff x mean |dFoM / d thickness| (reflection designs), 0 disables
+        self.robust_coeff = getattr(params, 'robust_coeff', 0.)
+        if self.robust_coeff and (self.sensor or self.objectives):
+            raise ValueError('robust_coeff supports the reflection objective only')
 
         if self.sensor:
-            self.led_spline = self._create_spline("true-green-osram.csv")
-            self.ldr_spline = self._create_spline("ldr.csv")
+            self.spectral_response = SpectralResponse("true-green-osram.csv", "ldr.csv")
+            # weights of the training grid, built once so the training loop never hashes k
+            self.sensor_weights = self.spectral_response.weights(self.k, self.k_weights)
+        self._grid_sensor_weights = None # (grid version, weights of the active adaptive grid)
+
+        # reflection of discrete designs keyed by materials and thicknesses rounded to design_cache_resolution (same unit as thicknesses)
+        self.design_cache = DesignCache(getattr(params, 'design_cache_resolution', 1e-3),
+                                        getattr(params, 'design_cache_bytes', 256 * 1024 ** 2)) if getattr(params, 'design_cache', False) else None
+
+        # adaptive training grid, params.adaptive_grid is True or a dict of AdaptiveGrid options
+        self.adaptive_grid = None
+        if getattr(params, 'adaptive_grid', None):
+            options = params.adaptive_grid if isinstance(params.adaptive_grid, dict) else {}
+            weights = self.sensor_weights[0] if self.sensor else None
+            self.adaptive_grid = AdaptiveGrid(self.k, self.target_reflection, weights, **options)
+        self._grid_context_cache = None # (grid version, SolverContext of the active index set)
         
         self.ruta = params.ruta
         self.seed = params.seed
-        # tranining history
-        self.loss_training = []
+        # checkpointing every checkpoint_iter iterations (0 disables), written from a background thread
+        self.checkpoint_iter = getattr(params, 'checkpoint_iter', 0)
+        self.checkpoint_dir = getattr(params, 'checkpoint_dir', None) or os.path.join(str(self.ruta), 'seed_' + str(self.seed))
+        self._checkpoint_thread = None
+
+        # tranining history, flushed to checkpoint_dir/history.bin every history_flush_iter iterations
+        self.history = HistoryRecorder(getattr(params, 'history_path', os.path.join(self.checkpoint_dir, 'history.bin')),
+                                       getattr(params, 'history_flush_iter', 100), self.device,
+                                       getattr(params, 'history_population_stats', False))
         self.refractive_indices_training = []
         self.thicknesses_training = []
+
+        # opt-in per-phase instrumentation, summary in checkpoint_dir/profile.json
+        if getattr(params, 'profile', False):
+            self.profiler = PhaseProfiler(self.checkpoint_dir, trace = getattr(params, 'profile_trace', False))
+        else:
+            self.profiler = NullProfiler()
         
     def to_cuda_if_available(self, tensor):
         if torch.cuda.is_available():
@@ -92,18 +154,31 @@ class GLOnet():
                 self.matdatabase = self.to_cuda_if_available(params.matdatabase)
                 self.materials = self.to_cuda_if_available(params.materials)
 
-    def _create_spline(self, filename):
-        df = pd.read_csv(filename, sep=';', decimal=',')
-        df.columns = ['Wavelength [nm]', 'Reflection spectra']
-        spline = UnivariateSpline(df['Wavelength [nm]'] / 1000, df['Reflection spectra'])
-        spline.set_smoothing_factor(0.006)
-        return spline
+    @property
+    def loss_training(self):
+        return self.history.column('loss').tolist()
 
-    def train(self):
+    def train(self, reset_controller = False):
+        '''
+        trains from iteration iter0 (0, or the iteration restored by resume). A resumed run that the
+        controller had already stopped returns right away unless reset_controller is True.
+        '''
+        if self.iter0 > 0 and self.controller is not None and self.controller.stop_reason is not None:
+            if not reset_controller:
+                self.stop_iter = self.iter0
+                self.stop_reason = self.controller.stop_reason
+                return
+            self.controller.reset()
         self.generator.train()
+        if self.iter0 == 0:
+            self.history.reset()
+            self.alpha_offset = 0.
+            if self.controller is not None:
+                self.controller.reset()
+        self.profiler.start()
             
         # training loop
-        with tqdm(total=self.numIter) as t:
+        with tqdm(total=self.numIter, initial=self.iter0) as t:
             it = self.iter0  
             while True:
                 it +=1 
@@ -116,43 +191,170 @@ class GLOnet():
                 
                 # terminate the loop
                 if it > self.numIter:
+                    self._finish_training(self.numIter, 'numIter')
                     return 
 
-                # sample z
-                z = self.sample_z(self.batch_size)
-                
-                # generate a batch of images
-                if self.sensor:
-                    thicknesses, refractive_indices_empty, refractive_indices_full, _ = self.generator(z, self.alpha)
-                else:
-                    thicknesses, refractive_indices, _ = self.generator(z, self.alpha)
+                # sample z and generate a batch of images
+                with self.profiler.phase('generator'):
+                    z = self.sample_z(self.batch_size)
+                    if self.sensor:
+                        thicknesses, refractive_indices_empty, refractive_indices_full, P = self.generator(z, self.alpha)
+                    else:
+                        thicknesses, refractive_indices, P = self.generator(z, self.alpha)
+
+                # frequencies of this iteration: the full grid, or the adaptive subset and its solver context
+                k_grid, context, grid = self.k, None, self.adaptive_grid
+                if grid is not None:
+                    with self.profiler.phase('grid'):
+                        self._refine_grid(it, normIter, thicknesses, (refractive_indices_empty, refractive_indices_full) if self.sensor else refractive_indices)
+                    k_grid, context = grid.k, self._grid_context()
+
                 # calculate efficiencies and gradients using EM solver
                 if self.sensor:
-                    reflection_empty = TMM_solver(thicknesses, refractive_indices_empty, self.n_bot, self.n_top, self.k, self.theta, self.pol)
-                    reflection_full = TMM_solver(thicknesses, refractive_indices_full, self.n_bot, self.n_top, self.k, self.theta, self.pol)
+                    with self.profiler.phase('tmm_empty'):
+                        reflection_empty = self._solve(thicknesses, self._on_grid(refractive_indices_empty), k_grid, self.theta, self.pol, context = context)
+                    with self.profiler.phase('tmm_full'):
+                        reflection_full = self._solve(thicknesses, self._on_grid(refractive_indices_full), k_grid, self.theta, self.pol, context = context)
                 else:
-                    reflection = TMM_solver(thicknesses, refractive_indices, self.n_bot, self.n_top, self.k, self.theta, self.pol) 
+                    with self.profiler.phase('tmm'):
+                        if self.robust_coeff:
+                            reflection, dR_dd = self._solve_sensitivity(thicknesses, self._on_grid(refractive_indices), k_grid, context)
+                        else:
+                            reflection = self._solve(thicknesses, self._on_grid(refractive_indices), k_grid, self.theta, self.pol, return_result = bool(self.objectives), context = context) 
                 
                 # free optimizer buffer 
                 self.optimizer.zero_grad()
 
                 # construct the loss 
-                sensor_signal = self.sensor_signal(self.k, reflection_empty, reflection_full) if self.sensor else None
+                if self.sensor:
+                    with self.profiler.phase('sensor_signal'):
+                        sensor_signal = self.sensor_signal(k_grid, reflection_empty, reflection_full)
                 
-                g_loss = self.global_loss_function(sensor_signal) if self.sensor else self.global_loss_function(reflection)
+                with self.profiler.phase('loss'):
+                    if self.sensor:
+                        g_loss = self.global_loss_function(sensor_signal)
+                    elif self.robust_coeff:
+                        g_loss = self.global_loss_function_robust(reflection, dR_dd, grid)
+                    else:
+                        g_loss = self.global_loss_function(reflection, grid)
                                 
                 # record history
-                self.record_history(it, g_loss, thicknesses, refractive_indices) if not self.sensor else self.record_history(it, g_loss, thicknesses, refractive_indices_empty)
+                self.record_history(it, g_loss, thicknesses, refractive_indices, P) if not self.sensor else self.record_history(it, g_loss, thicknesses, refractive_indices_empty, P)
                 
                 # train the generator
-                g_loss.backward()
-                self.optimizer.step()
-                self.scheduler.step()
+                with self.profiler.phase('backward'):
+                    g_loss.backward()
+                with self.profiler.phase('optimizer'):
+                    self.optimizer.step()
+                    self.scheduler.step()
+                self.profiler.step(it, loss = g_loss, alpha = self.alpha)
+
+                # adaptive schedule and early termination
+                if self.controller is not None and self._control(it, normIter, g_loss, P):
+                    self._record_final(thicknesses, refractive_indices if not self.sensor else refractive_indices_empty)
+                    self._finish_training(it, self.controller.stop_reason)
+                    return
+
+                # checkpoint
+                if self.checkpoint_iter and it % self.checkpoint_iter == 0:
+                    self.save_checkpoint(it, blocking = False)
                 
                 # update progress bar
                 t.update()
+
+    def _control(self, it, normIter, loss, P):
+        # applies the controller's decision, returns True if training has to stop
+        lr = self.optimizer.param_groups[0]['lr']
+        action = self.controller.update(it, normIter, loss, P, lr, normIter + self.alpha_offset >= 1)
+        if action == 'advance_alpha':
+            self.alpha_offset += self.controller.alpha_step
+        elif action == 'reduce_lr':
+            for group in self.optimizer.param_groups:
+                group['lr'] *= self.controller.lr_factor
+        return action == 'stop'
+
+    def _finish_training(self, it, reason):
+        self.stop_iter = it
+        self.stop_reason = reason
+        self.history.flush()
+        self.wait_checkpoint()
+        self.profiler.stop()
+
+    def checkpoint_state(self, it):
+        '''
+        snapshot of everything train needs to continue after iteration it, copied to the CPU
+        '''
+        numpy_state = np.random.get_state()
+        state = {'gen_state_dict': self.generator.state_dict(),
+                 'optim_state_dict': self.optimizer.state_dict(),
+                 'scheduler_state_dict': self.scheduler.state_dict(),
+                 'iter': it,
+                 'alpha': self.alpha,
+                 'loss_training': self.loss_training,
+                 'history': torch.from_numpy(self.history.rows()),
+                 'grid_index': None if self.adaptive_grid is None else self.adaptive_grid.index,
+                 'alpha_offset': self.alpha_offset,
+                 'controller': None if self.controller is None else self.controller.state_dict(),
+                 'rng_state': {'torch': torch.get_rng_state(),
+                               'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+                               'numpy': [numpy_state[0], numpy_state[1].tolist()] + list(numpy_state[2:]),
+                               'random': random.getstate()}}
+        return _copy_to_cpu(state)
+
+    def save_checkpoint(self, it, blocking = True):
+        '''
+        writes checkpoint_dir/model.pth.tar atomically; with blocking = False the snapshot is taken
+        here and serialized in a background thread
+        '''
+        state = self.checkpoint_state(it)
+        path = os.path.join(self.checkpoint_dir, 'model.pth.tar')
+        self.wait_checkpoint()
+        if blocking:
+            save_checkpoint_atomic(state, path)
+        else:
+            self._checkpoint_thread = threading.Thread(target=save_checkpoint_atomic, args=(state, path), daemon=True)
+            self._checkpoint_thread.start()
+
+    def wait_checkpoint(self):
+        if self._checkpoint_thread is not None:
+            self._checkpoint_thread.join()
+            self._checkpoint_thread = None
+
+    def resume(self, path):
+        '''
+        restores a checkpoint written by save_checkpoint; train then continues at the next iteration
+        '''
+        checkpoint = load_checkpoint(path, self.generator, self.optimizer, self.scheduler)
+        self.iter0 = checkpoint['iter']
+        self.alpha = checkpoint['alpha']
+        if 'history' in checkpoint:
+            self.history.restore(checkpoint['history'].numpy())
+        else:
+            self.history.restore([[i + 1, loss, 0., 0.] + [0.] * (len(self.history.columns) - 4)
+                                  for i, loss in enumerate(checkpoint['loss_training'])])
+        rng_state = checkpoint['rng_state']
+        torch.set_rng_state(rng_state['torch'])
+        if torch.cuda.is_available() and len(rng_state['cuda']) > 0:
+            torch.cuda.set_rng_state_all(rng_state['cuda'])
+        numpy_state = rng_state['numpy']
+        np.random.set_state((numpy_state[0], np.array(numpy_state[1], dtype=np.uint32)) + tuple(numpy_state[2:]))
+        random.setstate(_to_tuple(rng_state['random']))
+        if self.adaptive_grid is not None and checkpoint.get('grid_index') is not None:
+            self.adaptive_grid.set_index(checkpoint['grid_index'])
+        self.alpha_offset = checkpoint.get('alpha_offset', 0.)
+        if self.controller is not None and checkpoint.get('controller') is not None:
+            self.controller.load_state_dict(checkpoint['controller'])
+        return checkpoint
     
     def evaluate(self, num_devices, kvector = None, inc_angles = None, pol = None, grayscale=True):
+        '''
+        samples num_devices designs and solves them without autograd, so the solves go through
+        TMM_solver_inference and, for discrete designs, the design cache
+        '''
+        with torch.no_grad():
+            return self._evaluate(num_devices, kvector, inc_angles, pol, grayscale)
+
+    def _evaluate(self, num_devices, kvector, inc_angles, pol, grayscale):
         if kvector is None:
             kvector = self.k
         if inc_angles is None:
@@ -167,18 +369,18 @@ class GLOnet():
             result_mat = torch.argmax(P, dim=2).detach() # batch size x number of layer
 
             if not grayscale:
-                ref_idx_empty, ref_idx_full = self._calculate_refractive_indices(kvector)
+                ref_idx_empty, ref_idx_full = self._calculate_refractive_indices(result_mat, kvector)
             else:
                 if self.user_define:
                     ref_idx_empty, ref_idx_full = refractive_indices_empty, refractive_indices_full
                 else:
-                    n_database_empty = self.to_cuda_if_available(self.matdatabase_empty.interp_wv(2 * math.pi/kvector, self.materials_empty, True).unsqueeze(0).unsqueeze(0))
+                    n_database_empty = self.matdatabase_empty.interp_wv(2 * math.pi/kvector, self.materials_empty, True, device = self.device, dtype = self.dtype).unsqueeze(0).unsqueeze(0)
                     ref_idx_empty = torch.sum(P.unsqueeze(-1) * n_database_empty, dim=2)
-                    n_database_full = self.to_cuda_if_available(self.matdatabase_full.interp_wv(2 * math.pi/kvector, self.materials_full, True).unsqueeze(0).unsqueeze(0))
+                    n_database_full = self.matdatabase_full.interp_wv(2 * math.pi/kvector, self.materials_full, True, device = self.device, dtype = self.dtype).unsqueeze(0).unsqueeze(0)
                     ref_idx_full = torch.sum(P.unsqueeze(-1) * n_database_full, dim=2)
             
-            reflection_empty = TMM_solver(thicknesses, ref_idx_empty, self.n_bot, self.n_top, self.to_cuda_if_available(kvector), self.to_cuda_if_available(inc_angles), pol)
-            reflection_full = TMM_solver(thicknesses, ref_idx_full, self.n_bot, self.n_top, self.to_cuda_if_available(kvector), self.to_cuda_if_available(inc_angles), pol)
+            reflection_empty = self._solve(thicknesses, ref_idx_empty, self.to_cuda_if_available(kvector), self.to_cuda_if_available(inc_angles), pol)
+            reflection_full = self._solve(thicknesses, ref_idx_full, self.to_cuda_if_available(kvector), self.to_cuda_if_available(inc_angles), pol)
             
             sensor_signal = self.sensor_signal(self.to_cuda_if_available(kvector), reflection_empty, reflection_full)
             
@@ -187,33 +389,73 @@ class GLOnet():
         else:
             thicknesses, refractive_indices, P = self.generator(z, self.alpha)
             result_mat = torch.argmax(P, dim=2).detach() # batch size x number of layer
-            if not grayscale:
-                if self.user_define:
-                    n_database = self.n_database # do not support dispersion
-                else:
-                    n_database = self.matdatabase.interp_wv(2 * math.pi/kvector, self.materials, True).unsqueeze(0).unsqueeze(0).type(self.dtype)
-            
-                one_hot = torch.eye(len(self.materials)).type(self.dtype)
-                ref_idx = torch.sum(one_hot[result_mat].unsqueeze(-1) * n_database, dim=2)
-            else:
-                if self.user_define:
-                    ref_idx = refractive_indices
-                else:
-                    n_database = self.matdatabase.interp_wv(2 * math.pi/kvector, self.materials, True).unsqueeze(0).unsqueeze(0).type(self.dtype)
-                    ref_idx = torch.sum(P.unsqueeze(-1) * n_database, dim=2)
+            ref_idx = self._design_refractive_indices(refractive_indices, P, result_mat, kvector, grayscale)
 
-            reflection = TMM_solver(thicknesses, ref_idx, self.n_bot, self.n_top, kvector.type(self.dtype), inc_angles.type(self.dtype), pol)
+            if not grayscale and not self.user_define:
+                # discrete designs, deduplicated through the design cache when it is enabled
+                reflection = self._TMM_solver(thicknesses, result_mat, kvector, inc_angles, pol)
+            else:
+                reflection = self._solve(thicknesses, ref_idx, kvector.type(self.dtype), inc_angles.type(self.dtype), pol)
             return (thicknesses, ref_idx, result_mat, reflection)
+
+    def evaluate_tiled(self, num_devices, kvector = None, inc_angles = None, pol = None, grayscale = True,
+                       memory_budget = 512 * 1024 ** 2, out = None, reductions = None):
+        '''
+        evaluate for grids too large to solve at once: the reflection is computed in tiles of devices x
+        frequencies x angles under memory_budget (bytes), streamed into out (e.g. tiling.open_memmap) and
+        reduced on the fly (e.g. {'average': AngleAverage(inc_angles), 'FoM': TargetFoM(target)}).
+        The configured backend solves the tiles, TMM_solver_inference for the default 'matmul' backend.
+
+        return:
+            thicknesses, ref_idx, result_mat, out, {name: reduction result}
+        '''
+        if self.sensor:
+            raise ValueError('evaluate_tiled supports reflection designs, use evaluate for the sensor signal')
+        if kvector is None:
+            kvector = self.k
+        if inc_angles is None:
+            inc_angles = self.theta
+        if pol is None:
+            pol = self.pol
+        kvector = self.to_cuda_if_available(kvector).type(self.dtype)
+        inc_angles = self.to_cuda_if_available(inc_angles).type(self.dtype)
+
+        self.generator.eval()
+        with torch.no_grad():
+            z = self.sample_z(num_devices)
+            thicknesses, refractive_indices, P = self.generator(z, self.alpha)
+            result_mat = torch.argmax(P, dim=2) # batch size x number of layer
+            ref_idx = self._design_refractive_indices(refractive_indices, P, result_mat, kvector, grayscale)
+
+        solver = {'fused': TMM_solver_fused, 'adjoint': TMM_solver_adjoint, 'compiled': TMM_solver_compiled}.get(self.backend, TMM_solver_inference)
+        out, results = TMM_solver_tiled(thicknesses, ref_idx, self.n_bot, self.n_top, kvector, inc_angles, pol,
+                                        memory_budget, out, reductions, solver, self.precision)
+        return thicknesses, ref_idx, result_mat, out, results
+
+    def _design_refractive_indices(self, refractive_indices, P, result_mat, kvector, grayscale):
+        # refractive indices of evaluated designs: P weighted (grayscale) or of the argmax material
+        if not grayscale:
+            if self.user_define:
+                n_database = self.n_database # do not support dispersion
+            else:
+                n_database = self.matdatabase.interp_wv(2 * math.pi/kvector, self.materials, True, device = self.device, dtype = self.dtype).unsqueeze(0).unsqueeze(0)
+
+            one_hot = torch.eye(len(self.materials), dtype = self.dtype, device = self.device)
+            return torch.sum(one_hot[result_mat].unsqueeze(-1) * n_database, dim=2)
+        if self.user_define:
+            return refractive_indices
+        n_database = self.matdatabase.interp_wv(2 * math.pi/kvector, self.materials, True, device = self.device, dtype = self.dtype).unsqueeze(0).unsqueeze(0)
+        return torch.sum(P.unsqueeze(-1) * n_database, dim=2)
       
     def _calculate_refractive_indices(self, result_mat, kvector):
         if self.user_define:
             n_database_empty = self.to_cuda_if_available(self.n_database_empty) # do not support dispersion
             n_database_full = self.to_cuda_if_available(self.n_database_full) # do not support dispersion
         else:
-            n_database_empty = self.to_cuda_if_available(self.matdatabase_empty.interp_wv(2 * math.pi / kvector, self.materials_empty, True).unsqueeze(0).unsqueeze(0))
-            n_database_full = self.to_cuda_if_available(self.matdatabase_full.interp_wv(2 * math.pi / kvector, self.materials_full, True).unsqueeze(0).unsqueeze(0))
+            n_database_empty = self.matdatabase_empty.interp_wv(2 * math.pi / kvector, self.materials_empty, True, device = self.device, dtype = self.dtype).unsqueeze(0).unsqueeze(0)
+            n_database_full = self.matdatabase_full.interp_wv(2 * math.pi / kvector, self.materials_full, True, device = self.device, dtype = self.dtype).unsqueeze(0).unsqueeze(0)
         
-        one_hot = self.to_cuda_if_available(torch.eye(len(self.materials_empty)))
+        one_hot = torch.eye(len(self.materials_empty), dtype = self.dtype, device = self.device)
         one_hot_mat = one_hot[result_mat].unsqueeze(-1)
         ref_idx_empty = torch.sum(one_hot_mat * n_database_empty, dim=2)
         ref_idx_full = torch.sum(one_hot_mat * n_database_full, dim=2)
@@ -226,47 +468,162 @@ class GLOnet():
             inc_angles = self.theta
         if pol is None:
             pol = self.pol  
-        n_database = self.matdatabase.interp_wv(2 * math.pi/kvector, self.materials, True).unsqueeze(0).unsqueeze(0).type(self.dtype)
-        one_hot = torch.eye(len(self.materials)).type(self.dtype)
+        solve = lambda thicknesses, result_mat: self._solve_discrete(thicknesses, result_mat, kvector, inc_angles, pol)
+        # cached results carry no gradient, so the cache only serves solves that do not need one
+        if self.design_cache is None or (torch.is_grad_enabled() and thicknesses.requires_grad):
+            return solve(thicknesses, result_mat)
+        grid = DesignCache.grid_key(kvector, inc_angles, pol, self.n_bot, self.n_top, tuple(self.materials), self.precision.key(), self.backend)
+        return self.design_cache.solve(thicknesses, result_mat, grid, solve)
+
+    def _solve_discrete(self, thicknesses, result_mat, kvector, inc_angles, pol):
+        n_database = self.matdatabase.interp_wv(2 * math.pi/kvector, self.materials, True, device = self.device, dtype = self.dtype).unsqueeze(0).unsqueeze(0)
+        one_hot = torch.eye(len(self.materials), dtype = self.dtype, device = self.device)
         ref_idx = torch.sum(one_hot[result_mat].unsqueeze(-1) * n_database, dim=2)
-        reflection = TMM_solver(thicknesses, ref_idx, self.n_bot, self.n_top, kvector.type(self.dtype), inc_angles.type(self.dtype), pol)
+        reflection = self._solve(thicknesses, ref_idx, kvector.type(self.dtype), inc_angles.type(self.dtype), pol)
         return reflection
+
+    def _refine_grid(self, it, normIter, thicknesses, refractive_indices):
+        # a few designs of the batch are solved on the full grid to decide where the adaptive grid needs points
+        grid = self.adaptive_grid
+        if not grid.due(it, normIter):
+            return
+        v = grid.validation_size
+        with torch.no_grad():
+            if self.sensor:
+                refractive_indices_empty, refractive_indices_full = refractive_indices
+                values = self._solve(thicknesses[:v], refractive_indices_empty[:v], self.k, self.theta, self.pol) \
+                       - self._solve(thicknesses[:v], refractive_indices_full[:v], self.k, self.theta, self.pol)
+            else:
+                values = self._solve(thicknesses[:v], refractive_indices[:v], self.k, self.theta, self.pol)
+            grid.refine(values, normIter)
+
+    def _grid_context(self):
+        # solver context of the current index set, rebuilt only after a refinement changed it
+        grid = self.adaptive_grid
+        if grid.is_full:
+            return self.tmm_context
+        cached = self._grid_context_cache
+        if cached is None or cached[0] != grid.version:
+            context = SolverContext(grid.select(self.n_bot), grid.select(self.n_top), grid.k, self.theta, self.pol, self.precision)
+            cached = self._grid_context_cache = (grid.version, context)
+        return cached[1]
+
+    def _on_grid(self, refractive_indices):
+        # batch size x number of layers x number of frequencies restricted to the adaptive grid
+        return refractive_indices if self.adaptive_grid is None else self.adaptive_grid.select(refractive_indices)
+
+    def _solve(self, thicknesses, refractive_indices, kvector, inc_angles, pol, return_result = False, context = None):
+        # the training configuration reuses the context built at init, other grids go through the LRU cache
+        if context is None and kvector is self.k and inc_angles is self.theta and pol == self.pol:
+            context = self.tmm_context
+        elif context is None:
+            context = get_solver_context(self.n_bot, self.n_top, kvector, inc_angles, pol, self.precision)
+
+        if return_result:
+            # TMMResult needs S10 and S11, which only the S matrix based solvers keep
+            if self.backend == 'fused':
+                return TMM_solver_fused(thicknesses, refractive_indices, self.n_bot, self.n_top, kvector, inc_angles, pol, context, return_result = True)
+            return TMM_solver(thicknesses, refractive_indices, self.n_bot, self.n_top, kvector, inc_angles, pol, self.reduction, context, return_result = True)
+
+        if not torch.is_grad_enabled() or not (thicknesses.requires_grad or refractive_indices.requires_grad):
+            # evaluation and screening: in-place solve into reused workspaces
+            return TMM_solver_inference(thicknesses, refractive_indices, self.n_bot, self.n_top, kvector, inc_angles, pol, context)
+        if self.backend == 'fused':
+            return TMM_solver_fused(thicknesses, refractive_indices, self.n_bot, self.n_top, kvector, inc_angles, pol, context)
+        if self.backend == 'adjoint':
+            return TMM_solver_adjoint(thicknesses, refractive_indices, self.n_bot, self.n_top, kvector, inc_angles, pol, context)
+        if self.backend == 'compiled':
+            return TMM_solver_compiled(thicknesses, refractive_indices, self.n_bot, self.n_top, kvector, inc_angles, pol, context)
+        return TMM_solver(thicknesses, refractive_indices, self.n_bot, self.n_top, kvector, inc_angles, pol, self.reduction, context)
+        
+    def _solve_sensitivity(self, thicknesses, refractive_indices, kvector, context = None):
+        # reflection and dR / d thickness on the training angles and pol, analytic for every backend
+        context = self.tmm_context if context is None else context
+        return TMM_solver_sensitivity(thicknesses, refractive_indices, self.n_bot, self.n_top, kvector, self.theta, self.pol, context)
         
     def update_alpha(self, normIter):
-        self.alpha = round(normIter/0.05) * self.alpha_sup + 1.
+        # alpha_offset: schedule advanced by the controller, the final alpha is unchanged
+        self.alpha = round(min(normIter + self.alpha_offset, 1.)/0.05) * self.alpha_sup + 1.
         
     def sample_z(self, batch_size):
         return self.to_cuda_if_available(torch.randn(batch_size, self.noise_dim, requires_grad=True))
 
     def spectra_int(self, spectra, k, dim):
-        lambdas = 2*math.pi/self.k
+        # quadrature weights apply to the training grid only, other grids use the trapezoid rule
+        if k is self.k and self.k_weights is not None:
+            return band_integral(spectra, self.k_weights, dim)
+        lambdas = 2*math.pi/k
         return torch.trapz(spectra, lambdas, dim= dim)
+
+    def hemispherical_reflection(self, reflection, inc_angles = None):
+        '''
+        reflection (batch size x number of frequencies x number of angles x number of pol) averaged over
+        the incidence angles with the sin(2 theta) dtheta measure and over polarizations: batch size x number of frequencies
+        '''
+        if inc_angles is None or inc_angles is self.theta:
+            return hemispherical_reflection(reflection, self.theta, self.theta_weights)
+        return hemispherical_reflection(reflection, inc_angles)
     
     def sensor_signal(self, k, reflection_empty, reflection_full):
-        lambdas = 2 * math.pi / self.k
-        led_x_ldr = self.to_cuda_if_available(torch.from_numpy(self.led_spline(lambdas) * self.ldr_spline(lambdas)))
-        
-        signal_empty = torch.matmul(reflection_empty.squeeze(),torch.diag(led_x_ldr))
-        signal_full = torch.matmul(reflection_full.squeeze(),torch.diag(led_x_ldr))
-        signal_diff = signal_empty - signal_full
-        int_led = self.spectra_int(self.to_cuda_if_available(torch.from_numpy(self.led_spline(lambdas))), self.k, dim = 0)
-        int_diff = self.spectra_int(signal_diff, self.k, dim = 1)
-        sensor_signal= torch.abs(int_diff)/int_led
-        return sensor_signal   
-
-    def global_loss_function(self, signal):
-        return -torch.mean(torch.exp(-torch.mean(torch.pow(signal - self.target_reflection, 2), dim=(1,2,3))/self.sigma)) if not self.sensor else -torch.mean(torch.exp(-torch.pow(signal - 1, 2)/self.sigma))
+        # LED x LDR weighted, LED normalized integral of the reflection difference on the grid k
+        grid = self.adaptive_grid
+        if k is self.k:
+            weights = self.sensor_weights
+        elif grid is not None and k is grid.k:
+            if self._grid_sensor_weights is None or self._grid_sensor_weights[0] != grid.version:
+                self._grid_sensor_weights = (grid.version, self.spectral_response.weights(k))
+            weights = self._grid_sensor_weights[1]
+        else:
+            weights = self.spectral_response.weights(k)
+        return self.spectral_response.apply(weights, reflection_empty, reflection_full)
+
+    def _grid_mean(self, values, grid = None):
+        # mean over frequencies, angles and pol estimating the mean over the full training grid: weighted by the
+        # quadrature weights if any and, on an adaptive subset, by the spacing of its points on the full grid
+        subset = grid is not None and not grid.is_full
+        if values.size(1) != (grid.size if subset else self.k.numel()) or values.size(2) != self.theta.numel():
+            return torch.mean(values, dim=(1,2,3))
+        k_weights = None if self.k_weights is None else self.k_weights.abs()
+        if subset:
+            spacing = grid.point_weights.to(values.device, torch.float64)
+            k_weights = spacing if k_weights is None else spacing * grid.select(k_weights)
+        if k_weights is None and self.theta_weights is None:
+            return torch.mean(values, dim=(1,2,3))
+        weights = torch.ones(1, values.size(1), values.size(2), 1, dtype=torch.float64, device=values.device)
+        if k_weights is not None:
+            weights = weights * k_weights.view(1, -1, 1, 1)
+        if self.theta_weights is not None:
+            weights = weights * self.theta_weights.view(1, 1, -1, 1)
+        weights = (weights / weights.sum()).to(values.dtype)
+        return torch.sum(values.mean(dim=3, keepdim=True) * weights, dim=(1,2,3))
+
+    def global_loss_function(self, signal, grid = None):
+        # grid: AdaptiveGrid the signal was computed on, targets are taken at its frequencies
+        on_grid = (lambda target: target) if grid is None else (lambda target: grid.select(target, dim = 1))
+        if isinstance(signal, TMMResult):
+            metric = sum(weight * self._grid_mean(torch.pow(getattr(signal, name) - on_grid(target), 2), grid)
+                         for name, (weight, target) in self.objectives.items())
+            return -torch.mean(torch.exp(-metric/self.sigma))
+        return -torch.mean(torch.exp(-self._grid_mean(torch.pow(signal - on_grid(self.target_reflection), 2), grid)/self.sigma)) if not self.sensor else -torch.mean(torch.exp(-torch.pow(signal - 1, 2)/self.sigma))
         
-    def global_loss_function_robust(self, reflection, thicknesses):
-        metric = torch.mean(torch.pow(reflection - self.target_reflection, 2), dim=(1,2,3))
-        dmdt = torch.autograd.grad(metric.mean(), thicknesses, create_graph=True)
-        return -torch.mean(torch.exp((-metric - self.robust_coeff *torch.mean(torch.abs(dmdt[0]), dim=1))/self.sigma))
+    def global_loss_function_robust(self, reflection, dR_dd, grid = None):
+        # dR_dd: batch size x number of layers x frequencies x angles x pol from TMM_solver_sensitivity,
+        # dmetric / dd_i = mean(2 (R - target) dR / dd_i) of every design
+        on_grid = (lambda target: target) if grid is None else (lambda target: grid.select(target, dim = 1))
+        error = reflection - on_grid(self.target_reflection)
+        metric = self._grid_mean(torch.pow(error, 2), grid)
+        sensitivity = 2 * error.unsqueeze(1) * dR_dd
+        dmdt = self._grid_mean(sensitivity.flatten(0, 1), grid).view(dR_dd.size(0), dR_dd.size(1))
+        return -torch.mean(torch.exp((-metric - self.robust_coeff *torch.mean(torch.abs(dmdt), dim=1))/self.sigma))
 
-    def record_history(self, it, loss, thicknesses, refractive_indices):
-        self.loss_training.append(loss.detach().numpy())
+    def record_history(self, it, loss, thicknesses, refractive_indices, P = None):
+        self.history.record(it, loss, self.alpha, self.optimizer.param_groups[0]['lr'], thicknesses, P)
         if it == self.numIter:
-            self.thicknesses_training.append(thicknesses.detach().numpy())
-            self.refractive_indices_training.append(refractive_indices.detach().numpy())
+            self._record_final(thicknesses, refractive_indices)
+
+    def _record_final(self, thicknesses, refractive_indices):
+        self.thicknesses_training.append(thicknesses.detach().cpu().numpy())
+        self.refractive_indices_training.append(refractive_indices.detach().cpu().numpy())
         
     def viz_training(self):
         plt.figure(figsize = (20, 5))
@@ -281,3 +638,19 @@ class GLOnet():
         np.savez(str(self.ruta)+'/seed_'+str(self.seed)+'/thicknesses', self.thicknesses_training)
         np.savez(str(self.ruta)+'/seed_'+str(self.seed)+'/ref_idxs', self.refractive_indices_training)
         
+
+
+def _copy_to_cpu(obj):
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: _copy_to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_copy_to_cpu(value) for value in obj)
+    return obj
+
+def _to_tuple(obj):
+    # random.setstate needs tuples back where serialization may have produced lists
+    if isinstance(obj, (list, tuple)):
+        return tuple(_to_tuple(value) for value in obj)
+    return obj
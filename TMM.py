@@ -1,4 +1,12 @@
+import math
+import types
+import logging
+from functools import cached_property
 import torch
+from cache import LRUCache, tensor_key
+from precision import DEFAULT_PRECISION
+
+logger = logging.getLogger(__name__)
 
 def transfer_matrix_layer(thickness, refractive_index, k, ky, pol):
     '''
@@ -60,7 +68,7 @@ def transfer_matrix_stack(thicknesses, refractive_indices, k, ky, pol = 'TM'):
     elif pol == 'both':
         num_pol = 2
 
-    T_stack = torch.eye(2, 2, dtype=torch.complex64).unsqueeze(0).unsqueeze(0).unsqueeze(0).unsqueeze(0)
+    T_stack = torch.eye(2, 2, dtype=refractive_indices.dtype, device=refractive_indices.device).unsqueeze(0).unsqueeze(0).unsqueeze(0).unsqueeze(0)
     T_stack = T_stack.repeat(batch_size, numfreq, num_angles, num_pol, 1, 1)
 
     for i in range(N):
@@ -74,17 +82,223 @@ def transfer_matrix_stack(thicknesses, refractive_indices, k, ky, pol = 'TM'):
         
     return T_stack
 
-def amp2field(refractive_index, k, ky, pol = 'TM'):
+def transfer_matrix_stack_tree(thicknesses, refractive_indices, k, ky, pol = 'TM'):
+    '''
+    Same result as transfer_matrix_stack, but all layer matrices are built in one vectorized
+    call over the layer dimension and then multiplied pairwise in log2(number of layers) levels.
+
+    args:
+        thickness (tensor): batch size x number of layers
+        refractive_indices (tensor): batch size x number of layers x (number of frequencies or 1)
+        k (tensor): 1 x number of frequencies x 1
+        ky (tensor): 1 x number of frequencies x number of angles 
+        pol (str): 'TM' or 'TE' or 'both'
+
+    return:
+        2 x 2 complex matrix:
+            element (tensor): batch size x number of frequencies x number of angles x number of pol
+    '''
+    N = thicknesses.size(-1)
+    numfreq = refractive_indices.size(-1)
+    batch_size = thicknesses.size(0)
+    num_angles = ky.size(2)
+
+    if pol in ['TM', 'TE']:
+        num_pol = 1
+    else:
+        num_pol = 2
+
+    # batch size x number of layers x number of frequencies x number of angles x number of pol
+    thickness = thicknesses.view(batch_size, N, 1, 1, 1)
+    refractive_index = refractive_indices.view(batch_size, N, numfreq, 1, 1)
+
+    T11, T12, T21, T22 = transfer_matrix_layer(thickness, refractive_index, k, ky, pol)
+    T_layers = torch.stack((T11, T12, T21, T22), dim=-1).view(batch_size, N, numfreq, num_angles, num_pol, 2, 2)
+
+    # multiply neighbouring pairs, keeping the layer order; an odd layer out is carried to the next level
+    while T_layers.size(1) > 1:
+        T_pairs = torch.matmul(T_layers[:, 0:-1:2], T_layers[:, 1::2])
+        if T_layers.size(1) % 2:
+            T_pairs = torch.cat((T_pairs, T_layers[:, -1:]), dim=1)
+        T_layers = T_pairs
+
+    return T_layers[:, 0]
+
+class SolverContext(object):
+    '''
+    Quantities of TMM_solver that only depend on (n_bot, n_top, k, theta, pol): ky, the bottom
+    amplitude-to-field matrix and the closed-form inverse of the top one. Build once per
+    configuration and pass as context to the solvers.
+
+    args:
+        n_bot (tensor): 1 or number of frequencies
+        n_top (tensor): 1 or number of frequencies
+        k (tensor): number of frequencies
+        theta (tensor): number of angles
+        pol (str): 'TM' or 'TE' or 'both'
+        precision (PrecisionPolicy): dtypes of the solve, DEFAULT_PRECISION (complex64) if None
+    '''
+    def __init__(self, n_bot, n_top, k, theta, pol = 'TM', precision = None):
+        self.pol = pol
+        self.precision = precision or DEFAULT_PRECISION
+        self.num_pol = 1 if pol in ['TM', 'TE'] else 2
+
+        # boundary quantities are computed in the boundary precision, k and ky are then cast to the solve precision
+        real_dtype = self.precision.boundary_real_dtype
+        k = k.view(1, -1, 1, 1).to(real_dtype)
+        ky = k * n_bot.view(1, -1, 1, 1).real.to(real_dtype) * torch.sin(theta.view(1, 1, -1, 1).to(real_dtype))
+        self.k = self.precision.real(k)
+        self.ky = self.precision.real(ky)
+        numfreq = self.k.size(1)
+        num_angles = self.ky.size(2)
+
+        # admittances q = kx / k / pol_multiplier of the outer media: 1 x number of frequencies x number of angles x number of pol
+        _, q_bot = _admittance(n_bot.view(1, -1, 1, 1).to(self.precision.boundary_dtype), k, ky, pol)
+        _, q_top = _admittance(n_top.view(1, -1, 1, 1).to(self.precision.boundary_dtype), k, ky, pol)
+        self.q_bot = q_bot.expand(1, numfreq, num_angles, self.num_pol)
+        self.h_top = (1 / (2 * q_top)).expand(1, numfreq, num_angles, self.num_pol)
+
+        # A2F = [[1, 1], [-q, q]], inverse(A2F) = [[1/2, -1/(2q)], [1/2, 1/(2q)]]
+        one = torch.ones_like(self.q_bot)
+        self.A2F_bot = torch.stack((one, one, -self.q_bot, self.q_bot), dim=-1).view(1, numfreq, num_angles, self.num_pol, 2, 2)
+        self.A2F_top_inv = torch.stack((0.5 * one, -self.h_top, 0.5 * one, self.h_top), dim=-1).view(1, numfreq, num_angles, self.num_pol, 2, 2)
+
+        # polarization as data for the compiled solver: 0 for TM, 1 for TE along the pol dimension
+        self.te_mask = torch.tensor([0.] if pol == 'TM' else [1.] if pol == 'TE' else [0., 1.],
+                                    dtype=self.precision.real_dtype, device=self.k.device).view(1, 1, 1, -1)
+
+_SOLVER_CONTEXTS = LRUCache(maxsize=16)
+
+def get_solver_context(n_bot, n_top, k, theta, pol = 'TM', precision = None):
+    '''
+    SolverContext for the configuration, reused from an LRU cache keyed by the tensor values
+    '''
+    precision = precision or DEFAULT_PRECISION
+    key = (tensor_key(n_bot), tensor_key(n_top), tensor_key(k), tensor_key(theta), pol, precision.key())
+    return _SOLVER_CONTEXTS.get_or_create(key, lambda: SolverContext(n_bot, n_top, k, theta, pol, precision))
+
+class TMMResult(object):
+    """Outputs of one solve, all derived from the S matrix entries S10, S11 and computed on first access.
+    With incidence from the bottom medium and nothing incident from the top:
+        r = -S10 / S11, t = det(S) / S11 = (q_bot / q_top) / S11 (the layer matrices are unimodular)
+        R = |r|^2, T = |t|^2 Re(q_top) / Re(q_bot), A = 1 - R - T
+
+    Example:
+    ```
+    result = TMM_solver(thicknesses, refractive_indices, n_bot, n_top, k, theta, pol, return_result = True)
+    loss = (result.reflection - target_R).pow(2).mean() + (result.transmission - target_T).pow(2).mean()
+    ```
+
+    elements (tensor): batch size x number of frequencies x number of angles x number of pol
+    """
+    def __init__(self, S10, S11, context):
+        self.S10 = S10
+        self.S11 = S11
+        self.context = context
+
+    @cached_property
+    def r(self):
+        return -self.S10 / self.S11
+
+    @cached_property
+    def t(self):
+        # q_bot / q_top = 2 q_bot h_top
+        return 2 * self.context.q_bot * self.context.h_top / self.S11
+
+    @cached_property
+    def reflection(self):
+        reflection = torch.pow(torch.abs(self.S10), 2) / torch.pow(torch.abs(self.S11), 2)
+        return self.context.precision.real(reflection)
+
+    @cached_property
+    def transmission(self):
+        q_top = 1 / (2 * self.context.h_top)
+        transmission = torch.pow(torch.abs(self.t), 2) * q_top.real / self.context.q_bot.real
+        return self.context.precision.real(transmission)
+
+    @cached_property
+    def absorption(self):
+        return 1 - self.reflection - self.transmission
+
+def _cast_inputs(thicknesses, refractive_indices, precision):
+    '''
+    the only casts of a solve: thicknesses to the real and refractive indices to the complex dtype of precision
+    '''
+    return precision.real(thicknesses), precision.complex(refractive_indices)
+
+def TMM_solver(thicknesses, refractive_indices, n_bot, n_top, k, theta, pol = 'TM', reduction = 'sequential', context = None, precision = None, return_result = False):
     '''
     args:
-        refractive_index (tensor): 1 x (number of frequencies or 1) x 1 x 1
+        thickness (tensor): batch size x number of layers
+        refractive_indices (tensor): batch size x number of layers x (number of frequencies or 1)
+        k (tensor): number of frequencies
+        theta (tensor): number of angles
+        n_bot (tensor): 1 or number of frequencies
+        n_top (tensor): 1 or number of frequencies
+        pol (str): 'TM' or 'TE' or 'both'
+        reduction (str): 'sequential' (layer by layer) or 'tree' (pairwise, log depth)
+        context (SolverContext): precomputed boundary quantities, looked up in the cache if None
+        precision (PrecisionPolicy): dtypes of the solve when context is None, DEFAULT_PRECISION if None
+        return_result (bool): return a TMMResult (reflection, transmission, absorption, r, t) instead of the reflection
+     
+    return:
+        reflection (tensor): batch size x number of frequencies x number of angles x number of pol
+    '''
+    if context is None:
+        context = get_solver_context(n_bot, n_top, k, theta, pol, precision)
+    precision = context.precision
+    thicknesses, refractive_indices = _cast_inputs(thicknesses, refractive_indices, precision)
+
+    # transfer matrix calculation
+    if reduction == 'tree':
+        T_stack = transfer_matrix_stack_tree(thicknesses, refractive_indices, context.k, context.ky, pol)
+    else:
+        T_stack = transfer_matrix_stack(thicknesses, refractive_indices, context.k, context.ky, pol)
+    
+    # S matrix
+    S_stack = torch.matmul(context.A2F_top_inv, torch.matmul(T_stack.to(precision.boundary_dtype), context.A2F_bot))
+    result = TMMResult(S_stack[:,:,:,:,1,0], S_stack[:,:,:,:,1,1], context)
+            
+    return result if return_result else result.reflection
+
+def _cmul(ar, ai, br, bi):
+    '''
+    complex product on split real / imaginary planes
+    '''
+    return ar * br - ai * bi, ar * bi + ai * br
+
+def _cdot(x, y, u, v):
+    '''
+    x * y + u * v for complex numbers given as (real, imag) pairs
+    '''
+    xy_r, xy_i = _cmul(x[0], x[1], y[0], y[1])
+    uv_r, uv_i = _cmul(u[0], u[1], v[0], v[1])
+    return xy_r + uv_r, xy_i + uv_i
+
+def _matmul2x2_planes(A, B):
+    '''
+    args:
+        A, B (tuple): 2 x 2 complex matrices as (11, 12, 21, 22), each entry a (real, imag) pair of tensors
+
+    return:
+        A @ B in the same format
+    '''
+    A11, A12, A21, A22 = A
+    B11, B12, B21, B22 = B
+    return (_cdot(A11, B11, A12, B21), _cdot(A11, B12, A12, B22),
+            _cdot(A21, B11, A22, B21), _cdot(A21, B12, A22, B22))
+
+def _admittance(refractive_index, k, ky, pol):
+    '''
+    args:
+        refractive_index (tensor): complex, broadcastable to k
         k (tensor): 1 x number of frequencies x 1 x 1
         ky (tensor): 1 x number of frequencies x number of angles x 1
         pol (str): 'TM' or 'TE' or 'both'
 
     return:
-        2 x 2 complex matrix:
-            element (tensor): 1 x number of frequencies x number of angles x number of pol
+        kx (tensor): ... x number of angles x 1
+        q = kx / k / pol_multiplier (tensor): ... x number of angles x number of pol
     '''
     kx = torch.sqrt(torch.pow(k * refractive_index, 2)  - torch.pow(ky, 2))
 
@@ -95,38 +309,49 @@ def amp2field(refractive_index, k, ky, pol = 'TM'):
         pol_multiplier = TMpol
     elif pol == 'TE':
         pol_multiplier = TEpol
-    elif pol == 'both':
+    else:
         pol_multiplier = torch.cat([TMpol, TEpol], dim = -1)
 
-    pol_dim = torch.ones_like(pol_multiplier)
-    
-    T11 = torch.ones_like(kx)*pol_dim
-    T11 = T11.to(torch.complex64)
+    return kx, kx / k / pol_multiplier
 
-    T12 = torch.ones_like(kx)*pol_dim
-    T12 = T12.to(torch.complex64)
+def transfer_matrix_layer_planes(thickness, refractive_index, k, ky, pol):
+    '''
+    Same matrix as transfer_matrix_layer, returned as split real / imaginary planes.
+    cos and sin of the complex phase are expanded with real trig / hyperbolic functions.
 
-    T21 = -kx / k / pol_multiplier
-    T21 = T21.to(torch.complex64)
+    args:
+        thickness (tensor): batch size x 1 x 1 x 1
+        refractive_index (tensor): complex, batch size x (number of frequencies or 1) x 1 x 1
+        k (tensor): 1 x number of frequencies x 1 x 1
+        ky (tensor): 1 x number of frequencies x number of angles x 1
+        pol (str): 'TM' or 'TE' or 'both'
 
-    T22 = kx / k / pol_multiplier
-    T22 = T22.to(torch.complex64)
+    return:
+        (T11, T12, T21, T22), each a (real, imag) pair:
+            element (tensor): batch size x number of frequencies x number of angles x (number of pol or 1)
+    '''
+    kx, q = _admittance(refractive_index, k, ky, pol)
+    a = kx.real * thickness
+    b = kx.imag * thickness
+    cos_a, sin_a = torch.cos(a), torch.sin(a)
+    cosh_b, sinh_b = torch.cosh(b), torch.sinh(b)
 
-    numfreq = kx.size(1)
-    num_angles = ky.size(2)
-    if pol in ['TM', 'TE']:
-        num_pol = 1
-    elif pol == 'both':
-        num_pol = 2
+    # cos(kx d) and 1j * sin(kx d)
+    cos_kd = (cos_a * cosh_b, -sin_a * sinh_b)
+    isin_kd = (-cos_a * sinh_b, sin_a * cosh_b)
 
-    # Stack them into a 2x2 complex matrix
-    
-    T = torch.stack((T11, T12, T21, T22), dim=-1).view(1, numfreq, num_angles, num_pol, 2, 2)
+    u = 1 / q
+    T12 = _cmul(isin_kd[0], isin_kd[1], u.real, u.imag)
+    T21 = _cmul(isin_kd[0], isin_kd[1], q.real, q.imag)
 
-    return T
+    return cos_kd, T12, T21, cos_kd
 
-def TMM_solver(thicknesses, refractive_indices, n_bot, n_top, k, theta, pol = 'TM'):
+def TMM_solver_fused(thicknesses, refractive_indices, n_bot, n_top, k, theta, pol = 'TM', context = None, precision = None, return_result = False):
     '''
+    Drop-in replacement for TMM_solver that never materializes a 2 x 2 matrix: the four entries
+    are kept as split real / imaginary planes and multiplied by hand with elementwise ops.
+    The boundary matrices are applied in closed form and only S10, S11 are formed.
+
     args:
         thickness (tensor): batch size x number of layers
         refractive_indices (tensor): batch size x number of layers x (number of frequencies or 1)
@@ -135,29 +360,526 @@ def TMM_solver(thicknesses, refractive_indices, n_bot, n_top, k, theta, pol = 'T
         n_bot (tensor): 1 or number of frequencies
         n_top (tensor): 1 or number of frequencies
         pol (str): 'TM' or 'TE' or 'both'
-     
+        context (SolverContext): precomputed boundary quantities, looked up in the cache if None
+        precision (PrecisionPolicy): dtypes of the solve when context is None, DEFAULT_PRECISION if None
+        return_result (bool): return a TMMResult instead of the reflection
+
     return:
-        2 x 2 complex matrix:
-            element (tensor): batch size x number of frequencies x number of angles x number of pol
+        reflection (tensor): batch size x number of frequencies x number of angles x number of pol
     '''
-    # adjust the format
-    n_bot = n_bot.view(1, -1, 1, 1)
-    n_top = n_top.view(1, -1, 1, 1)
-    k = k.view(1, -1, 1, 1)
-    ky = k * n_bot * torch.sin(theta.view(1, 1, -1, 1))
+    if context is None:
+        context = get_solver_context(n_bot, n_top, k, theta, pol, precision)
+    precision = context.precision
+    thicknesses, refractive_indices = _cast_inputs(thicknesses, refractive_indices, precision)
 
-    # transfer matrix calculation
-    T_stack = transfer_matrix_stack(thicknesses, refractive_indices, k, ky, pol)
-    
-    # amplitude to field convertion
-    A2F_bot = amp2field(n_bot, k, ky, pol)
-    A2F_top = amp2field(n_top, k, ky, pol)
-    
-    # S matrix
-    S_stack = torch.matmul(torch.inverse(A2F_top), torch.matmul(T_stack, A2F_bot))
-    
-    # reflection 
-    Reflection = torch.pow(torch.abs(S_stack[:,:,:,:,1,0]), 2) / torch.pow(torch.abs(S_stack[:,:,:,:,1,1]), 2)
-    Reflection = Reflection.double()
-            
-    return Reflection
\ No newline at end of file
+    k = context.k
+    ky = context.ky
+    N = thicknesses.size(-1)
+    numfreq = refractive_indices.size(-1)
+    batch_size = thicknesses.size(0)
+    shape = (batch_size, k.size(1), ky.size(2), context.num_pol)
+
+    one = torch.ones(shape, dtype=thicknesses.dtype, device=thicknesses.device)
+    zero = torch.zeros_like(one)
+    T_stack = ((one, zero), (zero, zero), (zero, zero), (one, zero))
+
+    for i in range(N):
+        thickness = thicknesses[:, i].view(-1, 1, 1, 1)
+        refractive_index = refractive_indices[:, i, :].view(-1, numfreq, 1, 1)
+        T_layer = transfer_matrix_layer_planes(thickness, refractive_index, k, ky, pol)
+        T_stack = _matmul2x2_planes(T_stack, T_layer)
+
+    # S = inverse(A2F_top) @ T_stack @ A2F_bot with A2F = [[1, 1], [-q, q]]
+    q_bot = (context.q_bot.real, context.q_bot.imag)
+    h_top = (context.h_top.real, context.h_top.imag)
+
+    boundary_dtype = precision.boundary_real_dtype
+    T11, T12, T21, T22 = [(re.to(boundary_dtype), im.to(boundary_dtype)) for re, im in T_stack]
+    T12_q = _cmul(T12[0], T12[1], q_bot[0], q_bot[1])
+    T22_q = _cmul(T22[0], T22[1], q_bot[0], q_bot[1])
+    # S10 = (T11 - T12 q_bot) / 2 + (T21 - T22 q_bot) h_top, S11 likewise with + signs
+    D10 = _cmul(T21[0] - T22_q[0], T21[1] - T22_q[1], h_top[0], h_top[1])
+    D11 = _cmul(T21[0] + T22_q[0], T21[1] + T22_q[1], h_top[0], h_top[1])
+    S10 = (0.5 * (T11[0] - T12_q[0]) + D10[0], 0.5 * (T11[1] - T12_q[1]) + D10[1])
+    S11 = (0.5 * (T11[0] + T12_q[0]) + D11[0], 0.5 * (T11[1] + T12_q[1]) + D11[1])
+
+    if return_result:
+        return TMMResult(torch.complex(*S10), torch.complex(*S11), context)
+
+    # reflection
+    Reflection = (torch.pow(S10[0], 2) + torch.pow(S10[1], 2)) / (torch.pow(S11[0], 2) + torch.pow(S11[1], 2))
+
+    return precision.real(Reflection)
+
+
+def _matmul2x2(A, B):
+    '''
+    args:
+        A, B (tuple): 2 x 2 complex matrices as (11, 12, 21, 22) tensors
+
+    return:
+        A @ B in the same format
+    '''
+    A11, A12, A21, A22 = A
+    B11, B12, B21, B22 = B
+    return (A11 * B11 + A12 * B21, A11 * B12 + A12 * B22,
+            A21 * B11 + A22 * B21, A21 * B12 + A22 * B22)
+
+def _adjoint2x2(A):
+    A11, A12, A21, A22 = A
+    return (torch.conj(A11), torch.conj(A21), torch.conj(A12), torch.conj(A22))
+
+def _S_entries(T, q_bot, h_top):
+    '''
+    S10, S11 of S = inverse(A2F_top) @ T @ A2F_bot, rows and columns as in TMM_solver_fused,
+    in the boundary precision of q_bot. Linear in T, so it also maps dT to dS10, dS11.
+    '''
+    T11, T12, T21, T22 = [x.to(q_bot.dtype) for x in T]
+    S10 = 0.5 * (T11 - T12 * q_bot) + (T21 - T22 * q_bot) * h_top
+    S11 = 0.5 * (T11 + T12 * q_bot) + (T21 + T22 * q_bot) * h_top
+    return S10, S11
+
+def transfer_matrix_entries(thickness, refractive_index, k, ky, pol, derivatives = False):
+    '''
+    args:
+        thickness (tensor): batch size x 1 x 1 x 1
+        refractive_index (tensor): complex, batch size x (number of frequencies or 1) x 1 x 1
+        k (tensor): 1 x number of frequencies x 1 x 1
+        ky (tensor): 1 x number of frequencies x number of angles x 1
+        pol (str): 'TM' or 'TE' or 'both'
+        derivatives (bool): also return the derivatives w.r.t. thickness and refractive index
+
+    return:
+        T (tuple): (T11, T12, T21, T22) as in transfer_matrix_layer
+        dT_dd, dT_dn (tuple): (d11, d12, d21) derivatives of T11 (= T22), T12 and T21, only if derivatives
+    '''
+    kx, q = _admittance(refractive_index, k, ky, pol)
+    phase = kx * thickness
+    c = torch.cos(phase)
+    s = torch.sin(phase)
+    T = (c, 1j * s / q, 1j * s * q, c)
+    if not derivatives:
+        return T
+
+    # d/d thickness
+    dT_dd = (-kx * s, 1j * kx * c / q, 1j * kx * c * q)
+
+    # d/d refractive index: dkx = k^2 n / kx, dq = q (dkx / kx - dp / p), p = 1 (TM) or -n^2 (TE)
+    dlogp_TE = 2 / refractive_index
+    dlogp_TM = torch.zeros_like(dlogp_TE)
+    if pol == 'TM':
+        dlogp = dlogp_TM
+    elif pol == 'TE':
+        dlogp = dlogp_TE
+    else:
+        dlogp = torch.cat([dlogp_TM, dlogp_TE], dim = -1)
+    dkx = torch.pow(k, 2) * refractive_index / kx
+    dq = q * (dkx / kx - dlogp)
+    dphase = dkx * thickness
+    dc = -s * dphase
+    ds = c * dphase
+    dT_dn = (dc, 1j * (ds - s * dq / q) / q, 1j * (ds * q + s * dq))
+
+    return T, dT_dd, dT_dn
+
+class TMMFunction(torch.autograd.Function):
+    '''
+    TMM solver with an analytic backward. The forward keeps only S10 and S11; the backward
+    recomputes the layer matrices and propagates the adjoint of the stack product from the
+    top layer down, storing prefix products only every sqrt(number of layers) layers.
+    Memory is therefore independent of the autograd graph of the layer loop.
+    '''
+    @staticmethod
+    def forward(ctx, thicknesses, refractive_indices, context):
+        ctx.complex_input = refractive_indices.is_complex()
+        if not ctx.complex_input:
+            refractive_indices = torch.complex(refractive_indices, torch.zeros_like(refractive_indices))
+
+        pol = context.pol
+        k, ky = context.k, context.ky
+        q_bot, h_top = context.q_bot, context.h_top
+
+        N = thicknesses.size(-1)
+        T_stack = TMMFunction._identity(thicknesses, refractive_indices, k, ky, pol)
+        for i in range(N):
+            T_stack = _matmul2x2(T_stack, TMMFunction._layer(thicknesses, refractive_indices, k, ky, pol, i))
+
+        S10, S11 = _S_entries(T_stack, q_bot, h_top)
+
+        ctx.pol = pol
+        ctx.real_dtype = thicknesses.dtype
+        ctx.save_for_backward(thicknesses, refractive_indices, k, ky, q_bot, h_top, S10, S11)
+
+        Reflection = torch.pow(torch.abs(S10), 2) / torch.pow(torch.abs(S11), 2)
+        return Reflection.to(ctx.real_dtype)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        thicknesses, refractive_indices, k, ky, q_bot, h_top, S10, S11 = ctx.saved_tensors
+        pol = ctx.pol
+        N = thicknesses.size(-1)
+        numfreq = refractive_indices.size(-1)
+
+        # adjoint of the reflection w.r.t. S10, S11 and then w.r.t. the stack product
+        g = grad_output.to(S10.real.dtype)
+        abs_S11 = torch.pow(torch.abs(S11), 2)
+        g10 = 2 * S10 * g / abs_S11
+        g11 = -2 * S11 * torch.pow(torch.abs(S10), 2) * g / torch.pow(abs_S11, 2)
+        X = (0.5 * (g10 + g11), 0.5 * torch.conj(q_bot) * (g11 - g10),
+             torch.conj(h_top) * (g10 + g11), torch.conj(q_bot * h_top) * (g11 - g10))
+        X = tuple(x.to(refractive_indices.dtype) for x in X)
+
+        grad_thicknesses = torch.zeros_like(thicknesses) if ctx.needs_input_grad[0] else None
+        grad_refractive_indices = torch.zeros_like(refractive_indices) if ctx.needs_input_grad[1] else None
+
+        # prefix products at the start of every segment
+        segment = max(1, int(math.ceil(math.sqrt(N))))
+        checkpoints = []
+        T_prefix = TMMFunction._identity(thicknesses, refractive_indices, k, ky, pol)
+        for i in range(N - 1):
+            if i % segment == 0:
+                checkpoints.append(T_prefix)
+            T_prefix = _matmul2x2(T_prefix, TMMFunction._layer(thicknesses, refractive_indices, k, ky, pol, i))
+        if (N - 1) % segment == 0:
+            checkpoints.append(T_prefix)
+
+        # X holds dL/d(T_i ... T_N-1) as the sweep goes down the stack
+        for start in reversed(range(0, N, segment)):
+            stop = min(start + segment, N)
+            prefixes = [checkpoints[start // segment]]
+            layers = []
+            for i in range(start, stop):
+                layers.append(TMMFunction._layer(thicknesses, refractive_indices, k, ky, pol, i, True))
+                if i < stop - 1:
+                    prefixes.append(_matmul2x2(prefixes[-1], layers[-1][0]))
+
+            for i in reversed(range(start, stop)):
+                T_i, dT_dd, dT_dn = layers[i - start]
+                G11, G12, G21, G22 = _matmul2x2(_adjoint2x2(prefixes[i - start]), X)
+                if grad_thicknesses is not None:
+                    grad = torch.conj(dT_dd[0]) * (G11 + G22) + torch.conj(dT_dd[1]) * G12 + torch.conj(dT_dd[2]) * G21
+                    grad_thicknesses[:, i] = grad.real.sum(dim=(1, 2, 3))
+                if grad_refractive_indices is not None:
+                    grad = torch.conj(dT_dn[0]) * (G11 + G22) + torch.conj(dT_dn[1]) * G12 + torch.conj(dT_dn[2]) * G21
+                    grad = grad.sum(dim=(2, 3))
+                    if numfreq == 1:
+                        grad = grad.sum(dim=1, keepdim=True)
+                    grad_refractive_indices[:, i, :] = grad
+                X = _matmul2x2(X, _adjoint2x2(T_i))
+
+        if grad_refractive_indices is not None and not ctx.complex_input:
+            grad_refractive_indices = grad_refractive_indices.real
+
+        return grad_thicknesses, grad_refractive_indices, None
+
+    @staticmethod
+    def _layer(thicknesses, refractive_indices, k, ky, pol, i, derivatives = False):
+        thickness = thicknesses[:, i].view(-1, 1, 1, 1)
+        refractive_index = refractive_indices[:, i, :].view(thicknesses.size(0), -1, 1, 1)
+        return transfer_matrix_entries(thickness, refractive_index, k, ky, pol, derivatives)
+
+    @staticmethod
+    def _identity(thicknesses, refractive_indices, k, ky, pol):
+        num_pol = 1 if pol in ['TM', 'TE'] else 2
+        shape = (thicknesses.size(0), k.size(1), ky.size(2), num_pol)
+        one = torch.ones(shape, dtype=refractive_indices.dtype, device=refractive_indices.device)
+        zero = torch.zeros_like(one)
+        return (one, zero, zero, one)
+
+def TMM_solver_adjoint(thicknesses, refractive_indices, n_bot, n_top, k, theta, pol = 'TM', context = None, precision = None):
+    '''
+    Drop-in replacement for TMM_solver backed by TMMFunction (analytic, memory-lean backward).
+    Gradients are returned for thicknesses and refractive_indices only.
+    '''
+    if context is None:
+        context = get_solver_context(n_bot, n_top, k, theta, pol, precision)
+    thicknesses = context.precision.real(thicknesses)
+    if refractive_indices.is_complex():
+        refractive_indices = context.precision.complex(refractive_indices)
+    else:
+        refractive_indices = context.precision.real(refractive_indices)
+    return TMMFunction.apply(thicknesses, refractive_indices, context)
+
+def TMM_solver_sensitivity(thicknesses, refractive_indices, n_bot, n_top, k, theta, pol = 'TM', context = None, precision = None):
+    '''
+    Reflection and its derivatives w.r.t. every layer thickness from one analytic pass:
+    with prefix products P_i = T_0 ... T_i-1 and suffix products Q_i = T_i+1 ... T_N-1,
+    dT_stack / dd_i = P_i (dT_i / dd_i) Q_i, mapped to dS10, dS11 and then to dR. The prefixes
+    are the forward product, the suffixes are accumulated on the way down, so the cost is a few
+    stack products instead of a double backward. Both outputs are differentiable by autograd.
+
+    args:
+        as TMM_solver
+
+    return:
+        reflection (tensor): batch size x number of frequencies x number of angles x number of pol
+        dR_dd (tensor): batch size x number of layers x number of frequencies x number of angles x number of pol
+    '''
+    if context is None:
+        context = get_solver_context(n_bot, n_top, k, theta, pol, precision)
+    precision = context.precision
+    thicknesses, refractive_indices = _cast_inputs(thicknesses, refractive_indices, precision)
+    k, ky, q_bot, h_top = context.k, context.ky, context.q_bot, context.h_top
+    N = thicknesses.size(-1)
+
+    layers = [TMMFunction._layer(thicknesses, refractive_indices, k, ky, pol, i, True) for i in range(N)]
+    prefixes = [TMMFunction._identity(thicknesses, refractive_indices, k, ky, pol)]
+    for T_i, _, _ in layers:
+        prefixes.append(_matmul2x2(prefixes[-1], T_i))
+
+    S10, S11 = _S_entries(prefixes[-1], q_bot, h_top)
+    abs_S10 = torch.pow(torch.abs(S10), 2)
+    abs_S11 = torch.pow(torch.abs(S11), 2)
+    reflection = abs_S10 / abs_S11
+
+    # dR = 2 Re(conj(S10) dS10) / |S11|^2 - 2 |S10|^2 Re(conj(S11) dS11) / |S11|^4
+    a10 = 2 * torch.conj(S10) / abs_S11
+    a11 = 2 * torch.conj(S11) * abs_S10 / torch.pow(abs_S11, 2)
+    dR_dd = [None] * N
+    suffix = prefixes[0]
+    for i in reversed(range(N)):
+        T_i, (d11, d12, d21), _ = layers[i]
+        dT = _matmul2x2(_matmul2x2(prefixes[i], (d11, d12, d21, d11)), suffix)
+        dS10, dS11 = _S_entries(dT, q_bot, h_top)
+        dR_dd[i] = (a10 * dS10 - a11 * dS11).real
+        suffix = _matmul2x2(T_i, suffix)
+
+    real_dtype = precision.real_dtype
+    return reflection.to(real_dtype), torch.stack(dR_dd, dim=1).to(real_dtype)
+
+
+def _csqrt_planes(re, im):
+    '''
+    principal square root on (real, imag) planes, finite gradients on the whole branch cut except 0
+    '''
+    t = torch.sqrt(torch.clamp((torch.hypot(re, im) + torch.abs(re)) / 2, min=torch.finfo(re.dtype).tiny))
+    u = im / (2 * t)
+    sign = torch.where(im < 0, -torch.ones_like(im), torch.ones_like(im))
+    propagating = re >= 0
+    return torch.where(propagating, t, torch.abs(u)), torch.where(propagating, u, sign * t)
+
+def _transfer_matrix_layer_masked(thickness, n_re, n_im, k, ky, te_mask):
+    '''
+    transfer_matrix_layer_planes without the pol branch: the pol multiplier is 1 - te_mask (1 + n^2),
+    i.e. 1 for TM and -n^2 for TE
+
+    args:
+        thickness (tensor): batch size x 1 x 1 x 1
+        n_re, n_im (tensor): batch size x (number of frequencies or 1) x 1 x 1
+        k (tensor): 1 x number of frequencies x 1 x 1
+        ky (tensor): 1 x number of frequencies x number of angles x 1
+        te_mask (tensor): 1 x 1 x 1 x number of pol
+    '''
+    n2 = (n_re * n_re - n_im * n_im, 2 * n_re * n_im)
+    kx = _csqrt_planes(k * k * n2[0] - ky * ky, k * k * n2[1])
+    p = (1 - te_mask * (1 + n2[0]), -te_mask * n2[1])
+
+    # q = kx / (k p) and 1 / q = k p conj(kx) / |kx|^2
+    kp = (k * p[0], k * p[1])
+    kp_abs2 = kp[0] * kp[0] + kp[1] * kp[1]
+    q = _cmul(kx[0], kx[1], kp[0] / kp_abs2, -kp[1] / kp_abs2)
+    kx_abs2 = kx[0] * kx[0] + kx[1] * kx[1]
+    u = _cmul(kp[0], kp[1], kx[0] / kx_abs2, -kx[1] / kx_abs2)
+
+    a = kx[0] * thickness
+    b = kx[1] * thickness
+    cos_a, sin_a = torch.cos(a), torch.sin(a)
+    cosh_b, sinh_b = torch.cosh(b), torch.sinh(b)
+    cos_kd = (cos_a * cosh_b, -sin_a * sinh_b)
+    isin_kd = (-cos_a * sinh_b, sin_a * cosh_b)
+
+    T12 = _cmul(isin_kd[0], isin_kd[1], u[0], u[1])
+    T21 = _cmul(isin_kd[0], isin_kd[1], q[0], q[1])
+    return cos_kd, T12, T21, cos_kd
+
+def _reflection_planes(thicknesses, n_re, n_im, k, ky, te_mask, q_bot_re, q_bot_im, h_top_re, h_top_im):
+    '''
+    real-valued, branch-free TMM kernel traced by torch.compile; the layer loop is unrolled for the
+    static number of layers and no tensor is created from a Python shape
+    '''
+    batch_size = thicknesses.size(0)
+    T_stack = None
+    for i in range(thicknesses.size(1)):
+        T_layer = _transfer_matrix_layer_masked(thicknesses[:, i].view(-1, 1, 1, 1), n_re[:, i].view(batch_size, -1, 1, 1),
+                                                n_im[:, i].view(batch_size, -1, 1, 1), k, ky, te_mask)
+        T_stack = T_layer if T_stack is None else _matmul2x2_planes(T_stack, T_layer)
+
+    # boundaries as in TMM_solver_fused
+    T11, T12, T21, T22 = [(re.to(q_bot_re.dtype), im.to(q_bot_re.dtype)) for re, im in T_stack]
+    T12_q = _cmul(T12[0], T12[1], q_bot_re, q_bot_im)
+    T22_q = _cmul(T22[0], T22[1], q_bot_re, q_bot_im)
+    D10 = _cmul(T21[0] - T22_q[0], T21[1] - T22_q[1], h_top_re, h_top_im)
+    D11 = _cmul(T21[0] + T22_q[0], T21[1] + T22_q[1], h_top_re, h_top_im)
+    S10 = (0.5 * (T11[0] - T12_q[0]) + D10[0], 0.5 * (T11[1] - T12_q[1]) + D10[1])
+    S11 = (0.5 * (T11[0] + T12_q[0]) + D11[0], 0.5 * (T11[1] + T12_q[1]) + D11[1])
+    return ((S10[0] * S10[0] + S10[1] * S10[1]) / (S11[0] * S11[0] + S11[1] * S11[1])).to(thicknesses.dtype)
+
+# compiled kernels keyed by (number of layers, number of frequencies, number of angles, pol, dtype, device),
+# None once compilation failed for the key
+_COMPILED_SOLVERS = LRUCache(maxsize=32)
+
+def _compile(kernel, name):
+    '''
+    compiles a private copy of kernel: dynamo keeps its guards and recompile budget per code object,
+    so every shape configuration gets its own instead of sharing the budget of kernel
+    '''
+    if not hasattr(torch, 'compile'):
+        logger.warning('torch.compile unavailable, the compiled TMM backend runs the eager kernel')
+        return None
+    code = kernel.__code__.replace(co_name = name)
+    copy = types.FunctionType(code, kernel.__globals__, name, kernel.__defaults__, kernel.__closure__)
+    try:
+        return torch.compile(copy, dynamic=None)
+    except Exception as error:
+        logger.warning('torch.compile unavailable, the compiled TMM backend runs the eager kernel: %s', error)
+        return None
+
+def TMM_solver_compiled(thicknesses, refractive_indices, n_bot, n_top, k, theta, pol = 'TM', context = None, precision = None, compiled = True):
+    '''
+    Drop-in replacement for TMM_solver written for graph capture: real planes only, pol as a mask
+    along the last dimension and no data-dependent Python control flow. The kernel is compiled
+    once per layers / frequencies / angles / pol configuration with a dynamic batch dimension, so
+    training batches, evaluate and tiles of any size share it. It falls back to eager, with a
+    logged warning, if torch.compile is missing or fails.
+
+    args:
+        as TMM_solver_fused
+        compiled (bool): False runs the same kernel eagerly
+    '''
+    if context is None:
+        context = get_solver_context(n_bot, n_top, k, theta, pol, precision)
+    precision = context.precision
+    thicknesses, refractive_indices = _cast_inputs(thicknesses, refractive_indices, precision)
+    args = (thicknesses, refractive_indices.real, refractive_indices.imag, context.k, context.ky, context.te_mask,
+            context.q_bot.real, context.q_bot.imag, context.h_top.real, context.h_top.imag)
+    if not compiled:
+        return _reflection_planes(*args)
+
+    key = (thicknesses.size(1), context.k.size(1), context.ky.size(2), pol, str(thicknesses.dtype), str(thicknesses.device))
+    kernel = _COMPILED_SOLVERS.get_or_create(key, lambda: _compile(_reflection_planes, '_reflection_planes_{}'.format(len(_COMPILED_SOLVERS))))
+    if kernel is not None:
+        if thicknesses.size(0) > 1:
+            # batch sizes 0 and 1 are always specialized, every larger batch runs the same graph
+            for tensor in args[:3]:
+                torch._dynamo.mark_dynamic(tensor, 0)
+        try:
+            return kernel(*args)
+        except Exception as error:
+            # compilation happens on the first call; an error raised by the kernel itself repeats below
+            logger.warning('compiling the TMM kernel for %s failed, using the eager kernel: %s', key, error)
+            _COMPILED_SOLVERS.put(key, None)
+    return _reflection_planes(*args)
+
+
+# buffers of TMM_solver_inference, keyed by the shapes, dtypes and device of the solve
+_WORKSPACES = LRUCache(maxsize=4)
+
+def clear_workspaces():
+    '''
+    releases the buffers kept by TMM_solver_inference
+    '''
+    _WORKSPACES.clear()
+
+def _workspace(batch_size, numfreq, num_angles, num_pol, numfreq_n, precision, device):
+    key = (batch_size, numfreq, num_angles, num_pol, numfreq_n, precision.key(), str(device))
+
+    def create():
+        complex_dtype = precision.complex_dtype
+        boundary_dtype = precision.boundary_dtype
+        shape = (batch_size, numfreq, num_angles, num_pol)
+        return {'stack': torch.empty(shape + (2, 2), dtype=complex_dtype, device=device),
+                'product': torch.empty(shape + (2, 2), dtype=complex_dtype, device=device),
+                'layer': torch.empty(shape + (2, 2), dtype=complex_dtype, device=device),
+                'kn': torch.empty((batch_size, numfreq, 1, 1), dtype=complex_dtype, device=device),
+                'n2': torch.empty((batch_size, numfreq_n, 1, 1), dtype=complex_dtype, device=device),
+                'kx': torch.empty((batch_size, numfreq, num_angles, 1), dtype=complex_dtype, device=device),
+                'cos': torch.empty((batch_size, numfreq, num_angles, 1), dtype=complex_dtype, device=device),
+                'sin': torch.empty((batch_size, numfreq, num_angles, 1), dtype=complex_dtype, device=device),
+                'q': torch.empty(shape, dtype=complex_dtype, device=device),
+                'S10': torch.empty(shape, dtype=boundary_dtype, device=device),
+                'S11': torch.empty(shape, dtype=boundary_dtype, device=device),
+                'tmp': torch.empty(shape, dtype=boundary_dtype, device=device),
+                'abs': torch.empty(shape, dtype=precision.real_dtype, device=device)}
+    return _WORKSPACES.get_or_create(key, create)
+
+def TMM_solver_inference(thicknesses, refractive_indices, n_bot, n_top, k, theta, pol = 'TM', context = None, precision = None, out = None):
+    '''
+    Gradient-free TMM_solver for evaluation and screening: every layer is written in place into
+    buffers from a workspace pool that is reused by later calls with the same shapes, and the
+    stack is multiplied with out= matmuls, so a solve allocates nothing but its result.
+
+    args:
+        as TMM_solver
+        out (tensor): batch size x number of frequencies x number of angles x number of pol, real, optional
+
+    return:
+        reflection (tensor): batch size x number of frequencies x number of angles x number of pol, without autograd history
+    '''
+    if context is None:
+        context = get_solver_context(n_bot, n_top, k, theta, pol, precision)
+    precision = context.precision
+
+    with torch.no_grad():
+        thicknesses, refractive_indices = _cast_inputs(thicknesses, refractive_indices, precision)
+        k, ky = context.k, context.ky
+        N = thicknesses.size(-1)
+        batch_size = thicknesses.size(0)
+        numfreq_n = refractive_indices.size(-1)
+        ws = _workspace(batch_size, k.size(1), ky.size(2), context.num_pol, numfreq_n, precision, thicknesses.device)
+        stack, product, layer = ws['stack'], ws['product'], ws['layer']
+        kn, n2, kx, cos, sin, q = ws['kn'], ws['n2'], ws['kx'], ws['cos'], ws['sin'], ws['q']
+        ky2 = ky * ky
+
+        stack.zero_()
+        stack[..., 0, 0] = 1
+        stack[..., 1, 1] = 1
+        for i in range(N):
+            thickness = thicknesses[:, i].view(-1, 1, 1, 1)
+            refractive_index = refractive_indices[:, i, :].view(batch_size, -1, 1, 1)
+
+            # kx = sqrt((k n)^2 - ky^2), phase kx d
+            torch.mul(refractive_index, k, out=kn)
+            kn.mul_(kn)
+            torch.sub(kn, ky2, out=kx)
+            kx.sqrt_()
+            torch.mul(kx, thickness, out=cos)
+            sin.copy_(cos)
+            cos.cos_()
+            sin.sin_()
+
+            # q = kx / k / pol_multiplier with pol_multiplier 1 (TM) or -n^2 (TE)
+            if pol in ['TM', 'TE']:
+                q.copy_(kx).div_(k)
+            else:
+                q[..., 0:1].copy_(kx).div_(k)
+                q[..., 1:2].copy_(kx).div_(k)
+            if pol != 'TM':
+                torch.mul(refractive_index, refractive_index, out=n2)
+                q[..., -1:].div_(n2).neg_()
+
+            # T = [[c, i s / q], [i s q, c]]
+            layer[..., 0, 0].copy_(cos)
+            layer[..., 1, 1].copy_(cos)
+            layer[..., 0, 1].copy_(sin).div_(q).mul_(1j)
+            layer[..., 1, 0].copy_(sin).mul_(q).mul_(1j)
+
+            torch.matmul(stack, layer, out=product)
+            stack, product = product, stack
+
+        # S10 = (T11 - T12 q_bot) / 2 + (T21 - T22 q_bot) h_top, S11 likewise with + signs
+        S10, S11, tmp = ws['S10'], ws['S11'], ws['tmp']
+        torch.mul(stack[..., 0, 1], context.q_bot, out=tmp)
+        torch.sub(stack[..., 0, 0], tmp, out=S10).mul_(0.5)
+        torch.add(stack[..., 0, 0], tmp, out=S11).mul_(0.5)
+        torch.mul(stack[..., 1, 1], context.q_bot, out=tmp)
+        S10.add_(tmp.neg_().add_(stack[..., 1, 0]).mul_(context.h_top))
+        torch.mul(stack[..., 1, 1], context.q_bot, out=tmp)
+        S11.add_(tmp.add_(stack[..., 1, 0]).mul_(context.h_top))
+
+        if out is None:
+            out = torch.empty(S10.shape, dtype=precision.real_dtype, device=S10.device)
+        torch.abs(S10, out=out)
+        out.square_()
+        torch.abs(S11, out=ws['abs'])
+        out.div_(ws['abs'].square_())
+    return out
@@ -0,0 +1,142 @@
+import torch
+
+class AdaptiveGrid(object):
+    """Subset of the wavenumber grid used by GLOnet.train, refined during training.
+
+    Training starts on a coarse subset of the full grid k (evenly spaced points, the end points
+    and the band edges of the target). Every refine_every iterations a few designs are solved on
+    the full grid; the points where linear interpolation from the subset misrepresents their
+    spectrum the most, weighted up where the target error is high, are added while the error
+    exceeds a tolerance that decreases to 0 at full_at, where the full grid takes over.
+    The grid is a set of indices into k, so targets, material dispersion and sensor weights
+    are taken at exactly the same points as on the full grid.
+
+    Args:
+        k: (tensor) full grid, number of frequencies
+        target: 1 x number of frequencies x number of angles x (number of pol or 1), reflection target if any
+        weights: (tensor) number of frequencies, importance of every frequency (e.g. sensor weights)
+        coarse: fraction of the full grid in the initial subset
+        refine_every: iterations between refinements
+        add_points: maximum number of points added per refinement, 5% of the full grid if None
+        tol: interpolation error below which no point is added, at the start of training
+        full_at: normalized iteration from which the full grid is used
+        validation_size: designs solved on the full grid per refinement
+    """
+    def __init__(self, k, target=None, weights=None, coarse=0.25, refine_every=20, add_points=None, tol=1e-3,
+                 full_at=0.9, validation_size=8):
+        self.k_full = k
+        self.num_full = k.numel()
+        self.target = target
+        # trapezoid weights over wavelength are negative on an increasing k grid, only their magnitude matters
+        self.weights = None if weights is None else weights.abs() / weights.abs().max()
+        self.refine_every = refine_every
+        self.add_points = add_points or max(1, self.num_full // 20)
+        self.tol = tol
+        self.full_at = full_at
+        self.validation_size = validation_size
+        self.set_index(self._initial_index(coarse))
+
+    def _initial_index(self, coarse):
+        num_points = max(2, int(round(coarse * self.num_full)))
+        index = torch.linspace(0, self.num_full - 1, num_points).round().long()
+        if self.target is not None and self.target.size(1) > 1:
+            # band edges: both sides of every jump of the target
+            jumps = (self.target[:, 1:] != self.target[:, :-1]).reshape(self.target.size(0), self.num_full - 1, -1).any(dim=2).any(dim=0)
+            edges = jumps.nonzero().view(-1).cpu()
+            index = torch.cat([index, edges, edges + 1])
+        return index
+
+    def set_index(self, index):
+        '''
+        index (tensor): frequencies of the full grid to train on, None for the full grid
+        '''
+        if index is not None:
+            index = torch.unique(index.to(self.k_full.device))
+            if index.numel() == self.num_full:
+                index = None
+        self.index = index
+        self.k = self.k_full if index is None else self.k_full[index]
+        self.point_weights = None if index is None else self._point_weights(index)
+        # incremented on every change, lets users cache what depends on the index set
+        self.version = getattr(self, 'version', -1) + 1
+
+    def _point_weights(self, index):
+        '''
+        number of full grid points every subset point stands for (trapezoid spacing on the full grid, the end
+        points extended to the ends of the full grid), sums to the size of the full grid
+        '''
+        position = index.double()
+        edges = torch.cat([position.new_tensor([-0.5]), (position[1:] + position[:-1]) / 2, position.new_tensor([self.num_full - 0.5])])
+        return edges[1:] - edges[:-1]
+
+    @property
+    def is_full(self):
+        return self.index is None
+
+    @property
+    def size(self):
+        return self.num_full if self.index is None else self.index.numel()
+
+    def select(self, tensor, dim=-1):
+        '''
+        tensor restricted to the grid along dim, unchanged if it holds a single frequency
+        '''
+        if self.index is None or tensor.size(dim) == 1:
+            return tensor
+        return tensor.index_select(dim, self.index)
+
+    def due(self, it, normIter):
+        '''
+        switches to the full grid at full_at, returns True if a refinement is due at iteration it
+        '''
+        if not self.is_full and normIter >= self.full_at:
+            self.set_index(None)
+        return not self.is_full and it % self.refine_every == 0
+
+    def interpolation_error(self, values):
+        '''
+        args:
+            values (tensor): batch size x number of frequencies x ... on the full grid
+
+        return:
+            (tensor) number of frequencies, mean |values - linear interpolation from the grid points|
+        '''
+        index = self.index
+        k = self.k_full.double()
+        positions = torch.arange(self.num_full, device=index.device)
+        upper = torch.searchsorted(index, positions).clamp(max=index.numel() - 1)
+        lower = (upper - 1).clamp(min=0)
+        hi = index[upper]
+        lo = torch.where(hi == positions, hi, index[lower])
+        t = torch.where(hi == lo, torch.zeros_like(k), (k - k[lo]) / torch.where(hi == lo, torch.ones_like(k), k[hi] - k[lo]))
+        shape = (1, -1) + (1,) * (values.dim() - 2)
+        t = t.to(values.dtype).view(shape)
+        interpolated = values[:, lo] + t * (values[:, hi] - values[:, lo])
+        return torch.abs(values - interpolated).transpose(0, 1).reshape(self.num_full, -1).mean(dim=1)
+
+    def refine(self, values, normIter):
+        '''
+        args:
+            values (tensor): validation batch size x number of frequencies x ... on the full grid, the reflection
+                (or the reflection difference of a sensor) of a few current designs
+            normIter: normalized iteration, sets the tolerance
+
+        return:
+            number of points added
+        '''
+        with torch.no_grad():
+            score = self.interpolation_error(values)
+            if self.weights is not None:
+                score = score * self.weights.to(score.device, score.dtype)
+            if self.target is not None:
+                target_error = torch.pow(values - self.target, 2).transpose(0, 1).reshape(self.num_full, -1).mean(dim=1)
+                score = score * (1 + target_error / (target_error.mean() + 1e-12))
+
+            tol = self.tol * max(0., 1 - normIter / self.full_at)
+            score[self.index] = 0
+            candidates = (score > tol).nonzero().view(-1)
+            if candidates.numel() == 0:
+                return 0
+            added = candidates[torch.argsort(score[candidates], descending=True)[:self.add_points]]
+            self.set_index(torch.cat([self.index, added]))
+            return added.numel()
@@ -0,0 +1,334 @@
+"""Benchmark and correctness regression suite for the TMM solvers.
+
+Example:
+```
+python benchmark.py check
+python benchmark.py check --precision verification
+python benchmark.py configs --backends eager compiled
+python benchmark.py bench --layers 8 30 60 --save-baseline baseline.json
+python benchmark.py bench --layers 8 30 60 --compare baseline.json --threshold 0.2
+```
+"""
+import json
+import time
+import argparse
+import itertools
+from functools import partial
+import numpy as np
+import torch
+from TMM import TMM_solver, TMM_solver_fused, TMM_solver_adjoint, TMM_solver_compiled, TMM_solver_inference, TMM_solver_sensitivity
+from precision import PrecisionPolicy
+
+BACKENDS = {
+    'matmul': TMM_solver,
+    'tree': partial(TMM_solver, reduction='tree'),
+    'fused': TMM_solver_fused,
+    'adjoint': TMM_solver_adjoint,
+    'eager': partial(TMM_solver_compiled, compiled=False),
+    'compiled': TMM_solver_compiled,
+    'inference': TMM_solver_inference,
+}
+
+# backends without autograd, only their forward is timed
+INFERENCE_ONLY = {'inference'}
+
+# training configurations of the notebooks: (batch size, number of layers, number of frequencies, number of angles, pol)
+CONFIGS = {
+    'LightBulbFilter': (500, 30, 230, 1, 'TM'),
+    'HR_sensor': (300, 8, 100, 1, 'TM'),
+}
+
+
+def reference_reflection(thicknesses, refractive_indices, n_bot, n_top, k, theta, pol='TM'):
+    """Independent float64 / complex128 numpy TMM.
+
+    Args:
+        thicknesses: batch size x number of layers
+        refractive_indices: batch size x number of layers x number of frequencies
+        n_bot, n_top: 1 or number of frequencies
+        k: number of frequencies
+        theta: number of angles
+        pol: 'TM', 'TE' or 'both'
+
+    Returns:
+        reflection (ndarray): batch size x number of frequencies x number of angles x number of pol
+    """
+    d = np.asarray(thicknesses, dtype=np.float64)
+    n = np.asarray(refractive_indices, dtype=np.complex128)
+    k = np.asarray(k, dtype=np.float64).reshape(-1)
+    theta = np.asarray(theta, dtype=np.float64).reshape(-1)
+    n_bot = np.broadcast_to(np.asarray(n_bot, dtype=np.complex128).reshape(-1), k.shape)
+    n_top = np.broadcast_to(np.asarray(n_top, dtype=np.complex128).reshape(-1), k.shape)
+    n = np.broadcast_to(n, d.shape + k.shape)
+    pols = [pol] if pol in ['TM', 'TE'] else ['TM', 'TE']
+
+    # in-plane wavevector, number of frequencies x number of angles
+    beta = k[:, None] * n_bot.real[:, None] * np.sin(theta)[None, :]
+
+    def admittance(n_medium, p):
+        kx = np.sqrt((k[:, None] * n_medium[..., None]) ** 2 - beta ** 2)
+        p_medium = 1. if p == 'TM' else -n_medium[..., None] ** 2
+        return kx, kx / k[:, None] / p_medium
+
+    reflection = np.zeros((d.shape[0], k.size, theta.size, len(pols)))
+    for j, p in enumerate(pols):
+        M = np.broadcast_to(np.eye(2, dtype=np.complex128), (d.shape[0], k.size, theta.size, 2, 2)).copy()
+        for i in range(d.shape[1]):
+            kx, q = admittance(n[:, i, :], p)
+            delta = kx * d[:, i, None, None]
+            layer = np.empty(delta.shape + (2, 2), dtype=np.complex128)
+            layer[..., 0, 0] = np.cos(delta)
+            layer[..., 0, 1] = 1j * np.sin(delta) / q
+            layer[..., 1, 0] = 1j * np.sin(delta) * q
+            layer[..., 1, 1] = np.cos(delta)
+            M = M @ layer
+
+        boundary = []
+        for n_medium in [n_bot, n_top]:
+            _, q = admittance(n_medium, p)
+            A = np.empty(q.shape + (2, 2), dtype=np.complex128)
+            A[..., 0, 0] = 1.
+            A[..., 0, 1] = 1.
+            A[..., 1, 0] = -q
+            A[..., 1, 1] = q
+            boundary.append(A)
+        S = np.linalg.solve(np.broadcast_to(boundary[1], M.shape), M @ boundary[0])
+        reflection[..., j] = np.abs(S[..., 1, 0]) ** 2 / np.abs(S[..., 1, 1]) ** 2
+    return reflection
+
+
+def random_problem(batch_size, N_layers, numfreq, num_angles, lossy=True, seed=0, device='cpu'):
+    """Random stack in the range of the notebooks: 20-300 nm layers, n in [1.3, 2.6], 0.3-2.5 um"""
+    generator = torch.Generator().manual_seed(seed)
+    thicknesses = 0.02 + 0.28 * torch.rand(batch_size, N_layers, generator=generator)
+    n = 1.3 + 1.3 * torch.rand(batch_size, N_layers, numfreq, generator=generator)
+    kappa = 0.05 * torch.rand(batch_size, N_layers, numfreq, generator=generator) if lossy else torch.zeros_like(n)
+    refractive_indices = torch.complex(n, kappa)
+    k = 2 * np.pi / torch.linspace(0.3, 2.5, numfreq)
+    theta = torch.linspace(0, np.pi / 2.25, num_angles)
+    n_bot = torch.tensor([1.])
+    n_top = torch.tensor([1.46])
+    return [x.to(device) for x in (thicknesses, refractive_indices, n_bot, n_top, k, theta)]
+
+
+def check_backends(backends=None, atol=1e-4, verbose=True, precision=None):
+    """Compares every backend with reference_reflection on small lossless and lossy problems,
+    solved with precision (PrecisionPolicy, float32 / complex64 if None).
+
+    Returns:
+        (dict) backend -> max abs error over all checked problems
+    """
+    backends = backends or list(BACKENDS)
+    errors = {name: 0. for name in backends}
+    for pol, lossy, num_angles in itertools.product(['TM', 'TE', 'both'], [False, True], [1, 7]):
+        problem = random_problem(4, 9, 13, num_angles, lossy=lossy, seed=num_angles)
+        reference = reference_reflection(*[x.numpy() for x in problem], pol=pol)
+        for name in backends:
+            with torch.no_grad():
+                reflection = BACKENDS[name](*problem, pol=pol, precision=precision).cpu().double().numpy()
+            errors[name] = max(errors[name], float(np.abs(reflection - reference).max()))
+    if verbose:
+        for name, error in errors.items():
+            print('{:10s} max |R - R_ref| = {:.2e} {}'.format(name, error, 'ok' if error < atol else 'FAIL'))
+    return errors
+
+
+def check_gradients(backend='adjoint', rtol=1e-3, verbose=True, precision=None):
+    """Gradcheck-style comparison of a backend's gradients w.r.t. thicknesses and refractive
+    indices with autograd through the matmul TMM_solver, both solved with precision.
+
+    Returns:
+        (dict) input name -> max relative error
+    """
+    errors = {}
+    for pol in ['TM', 'TE', 'both']:
+        thicknesses, refractive_indices, n_bot, n_top, k, theta = random_problem(3, 7, 11, 5, seed=1)
+        weights = torch.rand(3, 11, 5, 2 if pol == 'both' else 1, generator=torch.Generator().manual_seed(2)).double()
+        grads = []
+        for solver in [TMM_solver, BACKENDS[backend]]:
+            d = thicknesses.clone().requires_grad_(True)
+            n = refractive_indices.clone().requires_grad_(True)
+            (solver(d, n, n_bot, n_top, k, theta, pol=pol, precision=precision) * weights).sum().backward()
+            grads.append((d.grad, n.grad))
+        for name, expected, actual in zip(['thicknesses', 'refractive_indices'], grads[0], grads[1]):
+            error = float(((actual - expected).abs().max() / expected.abs().max()).item())
+            errors[(name, pol)] = error
+            if verbose:
+                print('{:10s} {:20s} {:5s} rel. error = {:.2e} {}'.format(backend, name, pol, error, 'ok' if error < rtol else 'FAIL'))
+    return errors
+
+
+def check_sensitivity(rtol=1e-3, verbose=True, precision=None):
+    """Compares the thickness derivatives of TMM_solver_sensitivity, contracted with random weights,
+    with the autograd gradient of the matmul TMM_solver.
+
+    Returns:
+        (dict) pol -> max relative error
+    """
+    errors = {}
+    for pol in ['TM', 'TE', 'both']:
+        thicknesses, refractive_indices, n_bot, n_top, k, theta = random_problem(3, 7, 11, 5, seed=3)
+        weights = torch.rand(3, 11, 5, 2 if pol == 'both' else 1, generator=torch.Generator().manual_seed(4)).double()
+        d = thicknesses.clone().requires_grad_(True)
+        (TMM_solver(d, refractive_indices, n_bot, n_top, k, theta, pol=pol, precision=precision) * weights).sum().backward()
+        _, dR_dd = TMM_solver_sensitivity(thicknesses, refractive_indices, n_bot, n_top, k, theta, pol=pol, precision=precision)
+        actual = (dR_dd * weights.unsqueeze(1).to(dR_dd.dtype)).sum(dim=(2, 3, 4))
+        error = float(((actual - d.grad).abs().max() / d.grad.abs().max()).item())
+        errors[pol] = error
+        if verbose:
+            print('{:10s} {:20s} {:5s} rel. error = {:.2e} {}'.format('sensitivity', 'thicknesses', pol, error, 'ok' if error < rtol else 'FAIL'))
+    return errors
+
+
+def _peak_cpu_memory(fn):
+    """Peak bytes allocated by torch on the CPU while running fn, from torch.profiler memory events"""
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    events = sorted((e for e in prof.events() if e.name == '[memory]'), key=lambda e: e.time_range.start)
+    current = peak = 0
+    for event in events:
+        current += event.cpu_memory_usage
+        peak = max(peak, current)
+    return peak
+
+
+def benchmark_case(backend, batch_size, N_layers, numfreq, num_angles, pol, repeat=5, device='cpu', precision=None):
+    """Times forward and forward+backward of one backend on a random problem, solved with precision.
+
+    Returns:
+        (dict) forward / backward times in seconds (best of repeat) and peak memory in MB
+    """
+    solver = BACKENDS[backend]
+    problem = random_problem(batch_size, N_layers, numfreq, num_angles, device=device)
+    thicknesses, refractive_indices = problem[:2]
+
+    def forward():
+        with torch.no_grad():
+            solver(*problem, pol=pol, precision=precision)
+
+    def forward_backward():
+        d = thicknesses.clone().requires_grad_(True)
+        n = refractive_indices.clone().requires_grad_(True)
+        solver(d, n, *problem[2:], pol=pol, precision=precision).sum().backward()
+
+    result = {}
+    cases = [('forward', forward)]
+    if backend in INFERENCE_ONLY:
+        result.update({'forward_backward_time': float('nan'), 'forward_backward_peak_mb': float('nan')})
+    else:
+        cases.append(('forward_backward', forward_backward))
+    for name, fn in cases:
+        fn()
+        best = float('inf')
+        for _ in range(repeat):
+            if device != 'cpu':
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            fn()
+            if device != 'cpu':
+                torch.cuda.synchronize()
+            best = min(best, time.perf_counter() - start)
+        result[name + '_time'] = best
+
+        if device != 'cpu':
+            torch.cuda.reset_peak_memory_stats()
+            fn()
+            result[name + '_peak_mb'] = torch.cuda.max_memory_allocated() / 1024. ** 2
+        else:
+            result[name + '_peak_mb'] = _peak_cpu_memory(fn) / 1024. ** 2
+    return result
+
+
+def run_benchmarks(backends, batch_sizes, layers, freqs, angles, pols, repeat=5, device='cpu', verbose=True, precision=None):
+    """Sweeps every combination, returns {case key: metrics}"""
+    results = {}
+    for backend, batch_size, N_layers, numfreq, num_angles, pol in itertools.product(backends, batch_sizes, layers, freqs, angles, pols):
+        key = '{}/B{}/N{}/F{}/A{}/{}'.format(backend, batch_size, N_layers, numfreq, num_angles, pol)
+        results[key] = benchmark_case(backend, batch_size, N_layers, numfreq, num_angles, pol, repeat, device, precision)
+        if verbose:
+            r = results[key]
+            print('{:40s} fwd {:8.4f} s  fwd+bwd {:8.4f} s  peak {:8.1f} / {:8.1f} MB'.format(
+                key, r['forward_time'], r['forward_backward_time'], r['forward_peak_mb'], r['forward_backward_peak_mb']))
+    return results
+
+
+def run_configs(backends, configs=None, repeat=5, device='cpu', verbose=True, precision=None):
+    """Times the backends on the notebook configurations (CONFIGS), with speedups over the first backend"""
+    results = {}
+    for config in configs or list(CONFIGS):
+        batch_size, N_layers, numfreq, num_angles, pol = CONFIGS[config]
+        for backend in backends:
+            results[config + '/' + backend] = benchmark_case(backend, batch_size, N_layers, numfreq, num_angles, pol, repeat, device, precision)
+        if verbose:
+            reference = results[config + '/' + backends[0]]
+            for backend in backends:
+                r = results[config + '/' + backend]
+                print('{:30s} fwd {:8.4f} s ({:4.2f}x)  fwd+bwd {:8.4f} s ({:4.2f}x)'.format(
+                    config + '/' + backend, r['forward_time'], reference['forward_time'] / r['forward_time'],
+                    r['forward_backward_time'], reference['forward_backward_time'] / r['forward_backward_time']))
+    return results
+
+
+def compare_to_baseline(results, baseline, threshold=0.2, verbose=True):
+    """Flags every metric that is more than threshold (relative) above its baseline value.
+
+    Returns:
+        list of (case key, metric, baseline value, new value)
+    """
+    regressions = []
+    for key, metrics in results.items():
+        if key not in baseline:
+            continue
+        for metric, value in metrics.items():
+            reference = baseline[key].get(metric)
+            if reference and value > reference * (1 + threshold):
+                regressions.append((key, metric, reference, value))
+    if verbose:
+        for key, metric, reference, value in regressions:
+            print('REGRESSION {} {}: {:.4g} -> {:.4g} (+{:.0f}%)'.format(key, metric, reference, value, 100 * (value / reference - 1)))
+        if not regressions:
+            print('No regression above {:.0f}%'.format(100 * threshold))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('command', choices=['check', 'bench', 'configs'])
+    parser.add_argument('--backends', nargs='+', default=list(BACKENDS), choices=list(BACKENDS))
+    parser.add_argument('--batch', nargs='+', type=int, default=[100, 500])
+    parser.add_argument('--layers', nargs='+', type=int, default=[8, 16, 30, 60])
+    parser.add_argument('--freqs', nargs='+', type=int, default=[100, 400])
+    parser.add_argument('--angles', nargs='+', type=int, default=[1, 20])
+    parser.add_argument('--pol', nargs='+', default=['TM', 'TE', 'both'])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--save-baseline')
+    parser.add_argument('--compare')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    parser.add_argument('--precision', choices=['training', 'verification'], default='training')
+    args = parser.parse_args()
+
+    precision = getattr(PrecisionPolicy, args.precision)()
+    if args.command == 'check':
+        # float64 / complex128 solves are held to much tighter tolerances
+        atol, rtol = (1e-4, 1e-3) if args.precision == 'training' else (1e-10, 1e-6)
+        errors = check_backends(args.backends, atol, precision=precision)
+        gradient_errors = {}
+        for backend in ['adjoint', 'compiled']:
+            gradient_errors.update({(backend,) + key: error for key, error in check_gradients(backend, rtol, precision=precision).items()})
+        gradient_errors.update({('sensitivity', pol): error for pol, error in check_sensitivity(rtol, precision=precision).items()})
+        failed = any(error >= atol for error in errors.values()) or any(error >= rtol for error in gradient_errors.values())
+        raise SystemExit(1 if failed else 0)
+
+    if args.command == 'configs':
+        run_configs(args.backends, repeat=args.repeat, device=args.device, precision=precision)
+        raise SystemExit(0)
+
+    results = run_benchmarks(args.backends, args.batch, args.layers, args.freqs, args.angles, args.pol, args.repeat, args.device, precision=precision)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=4)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.threshold)
+        raise SystemExit(1 if regressions else 0)
@@ -0,0 +1,147 @@
+import hashlib
+from collections import OrderedDict
+import torch
+
+def tensor_key(tensor):
+    '''
+    hashable key built from the shape, dtype, device and values of a tensor
+    '''
+    data = tensor.detach().cpu().contiguous()
+    digest = hashlib.sha1(data.numpy().tobytes()).hexdigest()
+    return (tuple(tensor.shape), str(tensor.dtype), str(tensor.device), digest)
+
+class LRUCache(object):
+    """Bounded mapping that evicts the least recently used entry.
+
+    Example:
+    ```
+    cache = LRUCache(maxsize=16)
+    value = cache.get_or_create(key, lambda: expensive(key))
+    print(cache.stats())
+    ```
+    """
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        if key in self._data:
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get_or_create(self, key, factory):
+        if key in self._data:
+            return self.get(key)
+        self.misses += 1
+        value = factory()
+        self.put(key, value)
+        return value
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'maxsize': self.maxsize}
+
+class DesignCache(object):
+    """Solved designs keyed by a canonical design hash: material indices, thicknesses quantized to
+    resolution and a grid key (wavenumbers, angles, pol, ...). A batch is deduplicated first, only
+    the designs not in the cache are solved, once each, at their quantized thicknesses.
+    Entries are evicted least recently used first when the cache holds more than max_bytes.
+
+    Example:
+    ```
+    cache = DesignCache(resolution=1e-3)
+    grid = cache.grid_key(k, theta, pol)
+    reflection = cache.solve(thicknesses, result_mat, grid, lambda d, m: solve(d, m))
+    print(cache.stats())
+    ```
+    """
+    def __init__(self, resolution=1e-3, max_bytes=256 * 1024 ** 2):
+        self.resolution = resolution
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.duplicates = 0
+        self._data = OrderedDict()
+
+    @staticmethod
+    def grid_key(*grid):
+        '''
+        hashable key of everything besides the design that the result depends on; tensors are hashed by value
+        '''
+        return tuple(tensor_key(item) if torch.is_tensor(item) else item for item in grid)
+
+    def __len__(self):
+        return len(self._data)
+
+    def solve(self, thicknesses, result_mat, grid, solve_fn):
+        '''
+        args:
+            thicknesses (tensor): batch size x number of layers
+            result_mat (tensor): batch size x number of layers, material indices
+            grid: key from grid_key
+            solve_fn: (thicknesses, result_mat) -> batch size x ... results of those designs
+
+        return:
+            results (tensor): batch size x ..., detached
+        '''
+        quantized = torch.round(thicknesses.detach() / self.resolution).long()
+        designs = torch.cat([result_mat.detach().long(), quantized], dim=1)
+        unique, inverse = torch.unique(designs, dim=0, return_inverse=True)
+        self.duplicates += designs.size(0) - unique.size(0)
+
+        N = result_mat.size(1)
+        rows = unique.cpu().numpy()
+        keys = [(grid, row.tobytes()) for row in rows]
+        values = [self._get(key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is None]
+        if missing:
+            todo = unique[missing]
+            with torch.no_grad():
+                solved = solve_fn(todo[:, N:].to(thicknesses.dtype) * self.resolution, todo[:, :N])
+            for j, i in enumerate(missing):
+                values[i] = solved[j].clone()
+                self._put(keys[i], values[i])
+        return torch.stack(values)[inverse.to(values[0].device)]
+
+    def _get(self, key):
+        if key in self._data:
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+        self.misses += 1
+        return None
+
+    def _put(self, key, value):
+        self._data[key] = value
+        self.bytes += value.numel() * value.element_size()
+        while self.bytes > self.max_bytes and len(self._data) > 1:
+            _, evicted = self._data.popitem(last=False)
+            self.bytes -= evicted.numel() * evicted.element_size()
+
+    def clear(self):
+        self._data.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'duplicates': self.duplicates, 'size': len(self._data),
+                'bytes': self.bytes, 'max_bytes': self.max_bytes}
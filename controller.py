@@ -0,0 +1,114 @@
+import torch
+
+def population_diversity(P):
+    '''
+    args:
+        P (tensor): batch size x number of layers x number of materials, material probabilities
+
+    return:
+        Gini impurity 1 - sum_m pbar_m^2 of the batch-averaged material distribution, averaged over layers:
+        0 once every design uses the same material in every layer
+    '''
+    P = P.detach().reshape(P.size(0), P.size(1), -1)
+    pbar = P.mean(dim=0)
+    return float((1 - torch.sum(pbar * pbar, dim=-1)).mean())
+
+class TrainingController(object):
+    """Watches an exponential moving average of the loss and the population diversity during
+    GLOnet.train and decides, once the smoothed loss has not improved by min_delta for patience
+    iterations, to
+        1. advance the alpha schedule by alpha_step (normalized iterations) while it is not finished,
+        2. then multiply the learning rate by lr_factor down to min_lr,
+        3. then stop ('plateau').
+    A run also stops when the population has collapsed (diversity below min_diversity) and the loss
+    has plateaued ('converged'), or when after hopeless_after (normalized iterations) the smoothed
+    loss is still above hopeless_loss ('hopeless'). The reason is kept in stop_reason.
+    The smoothed loss stays on the device and is only read, together with the diversity,
+    every check_every iterations.
+
+    Example:
+    ```
+    params.controller = {'patience': 100, 'hopeless_loss': -0.05}
+    glonet = GLOnet(params)
+    glonet.train()
+    print(glonet.stop_reason, glonet.stop_iter)
+    ```
+    """
+    def __init__(self, smoothing=0.98, patience=100, min_delta=1e-4, warmup=50, check_every=10, alpha_step=0.05,
+                 lr_factor=0.5, min_lr=1e-5, min_diversity=0.01, hopeless_loss=None, hopeless_after=0.5):
+        self.smoothing = smoothing
+        self.check_every = check_every
+        self.patience = patience
+        self.min_delta = min_delta
+        self.warmup = warmup
+        self.alpha_step = alpha_step
+        self.lr_factor = lr_factor
+        self.min_lr = min_lr
+        self.min_diversity = min_diversity
+        self.hopeless_loss = hopeless_loss
+        self.hopeless_after = hopeless_after
+        self.reset()
+
+    def reset(self):
+        self.ema_loss = None
+        self.best_loss = float('inf')
+        self.stale = 0
+        self.steps = 0
+        self.diversity = 1.
+        self.stop_reason = None
+        self.events = []
+
+    def state_dict(self):
+        ema_loss = None if self.ema_loss is None else float(self.ema_loss)
+        return {'ema_loss': ema_loss, 'best_loss': self.best_loss, 'stale': self.stale, 'steps': self.steps,
+                'diversity': self.diversity, 'stop_reason': self.stop_reason, 'events': list(self.events)}
+
+    def load_state_dict(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def update(self, it, normIter, loss, P, lr, alpha_finished):
+        '''
+        args:
+            it, normIter: iteration and normalized iteration
+            loss (tensor): loss of the iteration
+            P (tensor): batch size x number of layers x number of materials
+            lr (float): current learning rate
+            alpha_finished (bool): the alpha schedule has reached its last value
+
+        return:
+            None, 'advance_alpha', 'reduce_lr' or 'stop'
+        '''
+        self.steps += 1
+        loss = loss.detach()
+        self.ema_loss = loss if self.ema_loss is None else self.smoothing * self.ema_loss + (1 - self.smoothing) * loss
+        if self.steps <= self.warmup or self.steps % self.check_every != 0:
+            return None
+
+        ema_loss = float(self.ema_loss)
+        self.diversity = population_diversity(P)
+        if ema_loss < self.best_loss - self.min_delta:
+            self.best_loss = ema_loss
+            self.stale = 0
+        else:
+            self.stale += self.check_every
+
+        if self.hopeless_loss is not None and normIter >= self.hopeless_after and ema_loss > self.hopeless_loss:
+            return self._event(it, 'stop', 'hopeless')
+        if self.stale < self.patience:
+            return None
+
+        self.stale = 0
+        if self.diversity < self.min_diversity:
+            return self._event(it, 'stop', 'converged')
+        if not alpha_finished:
+            return self._event(it, 'advance_alpha')
+        if lr * self.lr_factor >= self.min_lr:
+            return self._event(it, 'reduce_lr')
+        return self._event(it, 'stop', 'plateau')
+
+    def _event(self, it, action, reason = None):
+        self.events.append((it, action, reason))
+        if action == 'stop':
+            self.stop_reason = reason
+        return action
@@ -0,0 +1,144 @@
+import warnings
+import numpy as np
+import torch
+from scipy.optimize import least_squares
+
+# photon energy in eV of a wavelength in um
+HC_EV_UM = 1.23984198
+
+def cauchy(wv, p):
+    '''
+    n = A + B / wv^2 + C / wv^4, k = max(D + E / wv^2 + F / wv^4, 0), p = (A, B, C, D, E, F)
+    '''
+    x = 1 / torch.pow(wv, 2)
+    n = p[0] + p[1] * x + p[2] * x * x
+    k = torch.clamp(p[3] + p[4] * x + p[5] * x * x, min=0)
+    return torch.complex(n, k)
+
+def sellmeier(wv, p):
+    '''
+    n^2 = eps_inf + B1 wv^2 / (wv^2 - C1) + B2 wv^2 / (wv^2 - C2), lossless, p = (eps_inf, B1, C1, B2, C2)
+    '''
+    wv2 = torch.pow(wv, 2)
+    eps = p[0] + p[1] * wv2 / (wv2 - p[2]) + p[3] * wv2 / (wv2 - p[4])
+    return torch.complex(torch.sqrt(torch.clamp(eps, min=0)), torch.zeros_like(eps))
+
+def drude_lorentz(wv, p):
+    '''
+    eps = eps_inf - wp^2 / (w^2 + i gp w) + sum_j f_j w_j^2 / (w_j^2 - w^2 - i g_j w), energies in eV,
+    p = (eps_inf, wp, gp, f_1, w_1, g_1, f_2, w_2, g_2, ...)
+    '''
+    w = torch.complex(HC_EV_UM / wv, torch.zeros_like(wv))
+    eps = p[0] - p[1] ** 2 / (w * w + 1j * p[2] * w)
+    for j in range(3, p.numel(), 3):
+        eps = eps + p[j] * p[j + 1] ** 2 / (p[j + 1] ** 2 - w * w - 1j * p[j + 2] * w)
+    return torch.sqrt(eps)
+
+def _cauchy_start(wv, n, k):
+    # the Cauchy model is linear in its coefficients
+    X = np.stack([np.ones_like(wv), wv ** -2, wv ** -4], axis=1)
+    return [np.concatenate([np.linalg.lstsq(X, n, rcond=None)[0], np.linalg.lstsq(X, k, rcond=None)[0]])], (-np.inf, np.inf)
+
+def _sellmeier_start(wv, n, k):
+    uv = (0.95 * wv.min()) ** 2
+    ir = (1.05 * wv.max()) ** 2
+    start = [1., max(np.mean(n) ** 2 - 1, 0.1), 0.1 * uv, 0.1, 10 * ir]
+    bounds = ([0.5, 0., 0., 0., ir], [20., 50., uv, 1e4, 1e6])
+    return [start], bounds
+
+def _drude_lorentz_start(wv, n, k):
+    bounds = ([0.5, 0., 1e-4, 0., 0.1, 1e-3, 0., 0.1, 1e-3], [20., 20., 5., 100., 20., 10., 100., 20., 10.])
+    # bulk metals (Ag ~ 9 eV) and transparent conductors (ITO ~ 2 eV) need different plasma energies
+    starts = [[1., wp, 0.1, 1., 4., 0.5, 1., 6., 1.] for wp in [2., 5., 9.]]
+    return starts, bounds
+
+# name -> (closed-form torch model, starting points and bounds of the fit)
+MODELS = {'cauchy': (cauchy, _cauchy_start),
+          'sellmeier': (sellmeier, _sellmeier_start),
+          'drude_lorentz': (drude_lorentz, _drude_lorentz_start)}
+
+def evaluate(model, params, wv, ignoreloss = False, wv_range = None, check_range = True):
+    '''
+    args:
+        model (str): name in MODELS
+        params (tensor): coefficients of the model
+        wv (tensor): wavelengths in um, any shape, evaluated on its device
+        wv_range (list): [min, max] wavelengths of the fitted data; wavelengths outside are clamped to it,
+            like the tables, since the models are not physical off-range (Sellmeier poles, negative Cauchy k)
+        check_range (bool): warn when wavelengths are clamped, costs one device to host sync
+
+    return:
+        refractive index n + ik (complex tensor) with the shape of wv
+    '''
+    if wv_range is not None:
+        if check_range and bool(((wv < wv_range[0]) | (wv > wv_range[1])).any()):
+            warnings.warn('{} model evaluated outside its fitted range {:.3f}-{:.3f} um, wavelengths are clamped'.format(
+                model, wv_range[0], wv_range[1]))
+        wv = torch.clamp(wv, wv_range[0], wv_range[1])
+    N = MODELS[model][0](wv, params.to(wv.dtype))
+    if ignoreloss:
+        return torch.complex(N.real, torch.zeros_like(N.real))
+    return N
+
+def candidate_models(wv, n, k):
+    '''
+    models tried by fit('auto'): Drude-Lorentz for metallic data (negative permittivity somewhere),
+    Cauchy and Sellmeier otherwise
+    '''
+    if np.any(n ** 2 - k ** 2 < 0):
+        return ['drude_lorentz']
+    return ['cauchy', 'sellmeier']
+
+def fit(wv, n, k, model = 'auto'):
+    '''
+    least-squares fit of a dispersion model to tabulated n, k data, residuals relative to max(|n + ik|, 1)
+
+    args:
+        wv, n, k (ndarray): tabulated wavelengths (um), refractive index and extinction coefficient
+        model (str): name in MODELS, or 'auto' for the best of candidate_models
+
+    return:
+        (dict) 'model', 'params' (list), 'range' (wavelength range of the data) and the fit quality
+        'rms_n', 'rms_k', 'max_error' (max |N_model - N_data|) and 'max_rel_error'
+    '''
+    wv, n, k = [np.asarray(x, dtype=np.float64) for x in (wv, n, k)]
+    if model == 'auto':
+        fits = [fit(wv, n, k, name) for name in candidate_models(wv, n, k)]
+        return min(fits, key=lambda result: result['max_rel_error'])
+
+    data = n + 1j * k
+    scale = np.maximum(np.abs(data), 1.)
+    wv_t = torch.from_numpy(wv)
+
+    def residuals(p):
+        N = MODELS[model][0](wv_t, torch.from_numpy(p)).numpy()
+        r = (N - data) / scale
+        return np.concatenate([r.real, r.imag])
+
+    starts, bounds = MODELS[model][1](wv, n, k)
+    best = None
+    for start in starts:
+        start = np.asarray(start, dtype=np.float64)
+        if np.isfinite(bounds[0]).any():
+            start = np.clip(start, bounds[0], bounds[1])
+        result = least_squares(residuals, start, bounds=bounds)
+        if best is None or result.cost < best.cost:
+            best = result
+    return dict(model=model, params=best.x.tolist(), range=[float(wv.min()), float(wv.max())], **fit_quality(model, best.x, wv, n, k))
+
+def fit_quality(model, params, wv, n, k):
+    N = MODELS[model][0](torch.from_numpy(np.asarray(wv, dtype=np.float64)), torch.tensor(params, dtype=torch.float64)).numpy()
+    error = np.abs(N - (n + 1j * k))
+    return {'rms_n': float(np.sqrt(np.mean((N.real - n) ** 2))), 'rms_k': float(np.sqrt(np.mean((N.imag - k) ** 2))),
+            'max_error': float(error.max()), 'max_rel_error': float(np.max(error / np.maximum(np.abs(n + 1j * k), 1e-12)))}
+
+def fit_report(fits):
+    '''
+    text table of the fit quality of {material name: fit result}
+    '''
+    lines = ['{:28s} {:14s} {:>13s} {:>10s} {:>10s} {:>10s} {:>10s}'.format('material', 'model', 'range [um]', 'rms n', 'rms k', 'max err', 'max rel')]
+    for name, result in fits.items():
+        lines.append('{:28s} {:14s} {:>6.3f}-{:<6.3f} {:10.2e} {:10.2e} {:10.2e} {:10.2e}'.format(
+            name, result['model'], result['range'][0], result['range'][1], result['rms_n'], result['rms_k'],
+            result['max_error'], result['max_rel_error']))
+    return '\n'.join(lines)
@@ -0,0 +1,147 @@
+import copy
+import os
+import random
+import numpy as np
+import torch
+from tqdm import tqdm
+from GLOnet_thinfilm import GLOnet
+
+class GLOnetEnsemble():
+    """Trains one GLOnet per seed in a single process.
+
+    Every member keeps its own generator, optimizer, scheduler, alpha and loss history, and
+    draws its noise (and dropout masks) from its own RNG stream, seeded exactly like the serial
+    notebook loop. Only the TMM solves, which dominate an iteration, are batched: the designs
+    of all seeds go through one TMM_solver call. Each seed is therefore reproducible against
+    `torch.manual_seed(seed); GLOnet(params).train()` up to the batched solve.
+
+    Example:
+    ```
+    ensemble = GLOnetEnsemble(params, seeds=range(1, 201))
+    ensemble.train()
+    ensemble.viz_training()
+    ```
+    """
+    # GLOnet.train options the batched loop does not implement
+    UNSUPPORTED = ['objectives', 'robust_coeff', 'adaptive_grid', 'controller', 'checkpoint_iter']
+
+    def __init__(self, params, seeds):
+        unsupported = [name for name in self.UNSUPPORTED if getattr(params, name, None)]
+        if unsupported:
+            raise ValueError('GLOnetEnsemble does not support {}, train the seeds with GLOnet.train'.format(', '.join(unsupported)))
+        self.seeds = list(seeds)
+        self.members = []
+        self.rng_states = []
+        for i, seed in enumerate(self.seeds):
+            member_params = copy.copy(params)
+            member_params.seed = seed
+            # a shared params.history_path gets the member index as suffix, history.bin -> history_3.bin
+            if getattr(params, 'history_path', None):
+                root, ext = os.path.splitext(params.history_path)
+                member_params.history_path = '{}_{}{}'.format(root, i, ext)
+            torch.manual_seed(seed)
+            random.seed(seed)
+            np.random.seed(seed)
+            self.members.append(GLOnet(member_params))
+            self.rng_states.append(self._get_rng_state())
+
+        self.numIter = params.numIter
+        self.sensor = self.members[0].sensor
+        self.iter0 = 0
+
+    def _get_rng_state(self):
+        cuda_state = torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+        return (torch.get_rng_state(), cuda_state)
+
+    def _set_rng_state(self, state):
+        torch.set_rng_state(state[0])
+        if state[1] is not None:
+            torch.cuda.set_rng_state_all(state[1])
+
+    def _generate(self):
+        '''
+        runs every member's generator on its own RNG stream
+
+        return:
+            list of generator outputs, one per member
+        '''
+        outputs = []
+        for i, member in enumerate(self.members):
+            self._set_rng_state(self.rng_states[i])
+            z = member.sample_z(member.batch_size)
+            outputs.append(member.generator(z, member.alpha))
+            self.rng_states[i] = self._get_rng_state()
+        return outputs
+
+    def _solve(self, outputs):
+        '''
+        one batched TMM solve for all members (empty and full stacks together in sensor mode)
+
+        return:
+            list of per-member reflections, or of (reflection_empty, reflection_full) pairs
+        '''
+        solver = self.members[0]
+        sizes = [output[0].size(0) for output in outputs]
+        thicknesses = torch.cat([output[0] for output in outputs])
+        if self.sensor:
+            refractive_indices = torch.cat([output[1] for output in outputs] + [output[2] for output in outputs])
+            reflection = solver._solve(torch.cat([thicknesses, thicknesses]), refractive_indices, solver.k, solver.theta, solver.pol)
+            reflection_empty, reflection_full = torch.split(reflection, thicknesses.size(0))
+            return list(zip(torch.split(reflection_empty, sizes), torch.split(reflection_full, sizes)))
+        refractive_indices = torch.cat([output[1] for output in outputs])
+        reflection = solver._solve(thicknesses, refractive_indices, solver.k, solver.theta, solver.pol)
+        return list(torch.split(reflection, sizes))
+
+    def train(self):
+        for member in self.members:
+            member.generator.train()
+            if self.iter0 == 0:
+                member.history.reset()
+
+        # training loop
+        with tqdm(total=self.numIter) as t:
+            it = self.iter0
+            while True:
+                it += 1
+
+                # normalized iteration number
+                normIter = it / self.numIter
+
+                # discretizaton coeff.
+                for member in self.members:
+                    member.update_alpha(normIter)
+
+                # terminate the loop
+                if it > self.numIter:
+                    for member in self.members:
+                        member.history.flush()
+                    return
+
+                # generate every member's batch, then solve all of them at once
+                outputs = self._generate()
+                reflections = self._solve(outputs)
+
+                # construct the losses
+                losses = []
+                for member, output, reflection in zip(self.members, outputs, reflections):
+                    member.optimizer.zero_grad()
+                    if self.sensor:
+                        sensor_signal = member.sensor_signal(member.k, reflection[0], reflection[1])
+                        g_loss = member.global_loss_function(sensor_signal)
+                    else:
+                        g_loss = member.global_loss_function(reflection)
+                    member.record_history(it, g_loss, output[0], output[1], output[-1])
+                    losses.append(g_loss)
+
+                # the members share no parameters, so one backward gives each its own gradients
+                torch.stack(losses).sum().backward()
+                for member in self.members:
+                    member.optimizer.step()
+                    member.scheduler.step()
+
+                # update progress bar
+                t.update()
+
+    def viz_training(self):
+        for member in self.members:
+            member.viz_training()
@@ -0,0 +1,106 @@
+import os
+import json
+import numpy as np
+import torch
+
+COLUMNS = ['iter', 'loss', 'alpha', 'lr']
+POPULATION_COLUMNS = ['thickness_mean', 'thickness_std', 'binarization', 'diversity']
+
+def load_history(path):
+    """Reads a history file written by HistoryRecorder, also while the run is still writing it.
+
+    Returns:
+        (dict) column name -> ndarray
+    """
+    with open(path + '.json') as f:
+        columns = json.load(f)['columns']
+    data = np.fromfile(path, dtype=np.float64)
+    data = data[:data.size // len(columns) * len(columns)].reshape(-1, len(columns))
+    return {name: data[:, i] for i, name in enumerate(columns)}
+
+
+class HistoryRecorder(object):
+    """Per-iteration training history kept in a preallocated buffer on the training device.
+
+    Recording only issues device-side copies, so it never synchronizes with the device. Every
+    `flush_iter` rows the buffer is copied to the host in one transfer and appended to `path`
+    as raw float64 rows (column names in `path + '.json'`), which `load_history` can stream
+    while the run is in progress.
+
+    Args:
+        path: (string) history file, None keeps the history in memory only
+        flush_iter: (int) rows per flush
+        device: device of the buffer
+        population_stats: (bool) also record thickness mean/std, binarization and diversity of the batch
+    """
+    def __init__(self, path=None, flush_iter=100, device='cpu', population_stats=False):
+        self.path = path
+        self.columns = COLUMNS + (POPULATION_COLUMNS if population_stats else [])
+        self.population_stats = population_stats
+        self.buffer = torch.zeros(flush_iter, len(self.columns), dtype=torch.float64, device=device)
+        self.row = 0
+        self._chunks = []
+
+    def record(self, it, loss, alpha, lr, thicknesses=None, P=None):
+        row = self.buffer[self.row]
+        row[0] = it
+        row[1] = loss.detach()
+        row[2] = alpha
+        row[3] = lr
+        if self.population_stats and thicknesses is not None and P is not None:
+            P = P.detach()
+            row[4] = thicknesses.detach().mean()
+            row[5] = thicknesses.detach().std()
+            # mean probability of the chosen material, and Gini diversity of the batch-averaged choice
+            row[6] = P.max(dim=-1)[0].mean()
+            row[7] = (1 - torch.pow(P.mean(dim=0), 2).sum(dim=-1)).mean()
+        self.row += 1
+        if self.row == self.buffer.size(0):
+            self.flush()
+
+    def flush(self):
+        if self.row == 0:
+            return
+        chunk = self.buffer[:self.row].cpu().numpy()
+        self._chunks.append(chunk)
+        self.row = 0
+        if self.path is not None:
+            self._append(chunk)
+
+    def rows(self):
+        '''
+        all recorded rows (number of iterations x number of columns), flushing pending ones
+        '''
+        self.flush()
+        if not self._chunks:
+            return np.zeros((0, len(self.columns)))
+        return np.concatenate(self._chunks, axis=0)
+
+    def column(self, name):
+        return self.rows()[:, self.columns.index(name)]
+
+    def reset(self):
+        self.restore(np.zeros((0, len(self.columns))))
+
+    def restore(self, rows):
+        '''
+        replaces the history with rows (e.g. from a checkpoint), dropping rows written after it
+        '''
+        self.row = 0
+        self._chunks = [np.asarray(rows, dtype=np.float64).reshape(-1, len(self.columns))]
+        if self.path is not None:
+            self._write_header()
+            tmp_path = self.path + '.tmp'
+            self._chunks[0].tofile(tmp_path)
+            os.replace(tmp_path, self.path)
+
+    def _write_header(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path + '.json', 'w') as f:
+            json.dump({'columns': self.columns, 'dtype': 'float64'}, f)
+
+    def _append(self, chunk):
+        if not os.path.exists(self.path + '.json'):
+            self._write_header()
+        with open(self.path, 'ab') as f:
+            chunk.tofile(f)
@@ -1,52 +1,457 @@
+import os
+import json
+import time
+import hashlib
+import argparse
 import numpy as np
 import pandas as pd
 import torch
+from cache import LRUCache, tensor_key
+import dispersion
+
+SOURCE_DIR = './material_database'
+STORE_NAME = 'compiled_store'
+# fitted dispersion models live next to the compiled store, generated files like it
+MODELS_NAME = STORE_NAME + '.models.json'
+
+def _source_files(source_dir):
+	'''
+		return
+			dict : material name -> path of its mat_<name>.xlsx file
+	'''
+	files = {}
+	for file_name in sorted(os.listdir(source_dir)):
+		if file_name.startswith('mat_') and file_name.endswith('.xlsx'):
+			files[file_name[len('mat_'):-len('.xlsx')]] = os.path.join(source_dir, file_name)
+	return files
+
+def _file_hash(path):
+	with open(path, 'rb') as f:
+		return hashlib.sha1(f.read()).hexdigest()
+
+def read_xlsx(file_name):
+	'''
+		return
+			(wavelength, n, k) arrays of the tabulated dispersion data
+	'''
+	A = np.array(pd.read_excel(file_name))
+	return (A[:, 0], A[:, 1], A[:, 2])
+
+def compile_store(source_dir = SOURCE_DIR, store_path = None):
+	"""Parses every mat_*.xlsx in source_dir once and writes a compiled store: one raw float64
+	array (rows of wavelength, n, k) that can be memory-mapped, plus a json index of
+	material name -> row offset, length and the signature (mtime, size, sha1) of its source file.
+	The data goes to a new file named by its content hash and the index is swapped atomically;
+	older data files are left for cleanup_store.
+
+		Parameters:
+			source_dir: folder with the mat_*.xlsx files
+			store_path: path prefix of the store, defaults to source_dir/compiled_store
+
+		return
+			path of the json index
+	"""
+	store_path = store_path or os.path.join(source_dir, STORE_NAME)
+	blocks = []
+	index = {}
+	offset = 0
+	for name, path in _source_files(source_dir).items():
+		stat = os.stat(path)
+		block = np.stack(read_xlsx(path), axis=1).astype(np.float64)
+		index[name] = {'offset': offset, 'length': block.shape[0], 'mtime_ns': stat.st_mtime_ns,
+						'size': stat.st_size, 'sha1': _file_hash(path)}
+		blocks.append(block)
+		offset += block.shape[0]
+	data = np.concatenate(blocks, axis=0) if blocks else np.zeros((0, 3))
+
+	# the data file name carries its content hash, so the index is the only file replaced in place
+	token = hashlib.sha1(data.tobytes()).hexdigest()[:12]
+	data_file = os.path.basename(store_path) + '.' + token + '.npy'
+	data_path = os.path.join(os.path.dirname(store_path), data_file)
+	tmp_path = data_path + '.tmp%d' % os.getpid()
+	with open(tmp_path, 'wb') as f:
+		np.save(f, data)
+	os.replace(tmp_path, data_path)
+
+	index_path = store_path + '.json'
+	tmp_path = index_path + '.tmp%d' % os.getpid()
+	with open(tmp_path, 'w') as f:
+		json.dump({'data_file': data_file, 'materials': index}, f, indent=4)
+	os.replace(tmp_path, index_path)
+	# data files of previous compilations stay, readers holding the old index may still open them
+	return index_path
+
+def cleanup_store(source_dir = SOURCE_DIR, store_path = None):
+	'''
+		removes the data files of previous compilations, the ones the current index does not reference.
+		Not called by compile_store: run it when no reader holds an older index.
+
+		return
+			list of the removed file names
+	'''
+	store_path = store_path or os.path.join(source_dir, STORE_NAME)
+	with open(store_path + '.json') as f:
+		data_file = json.load(f)['data_file']
+	prefix = os.path.basename(store_path) + '.'
+	store_dir = os.path.dirname(store_path) or '.'
+	removed = []
+	for file_name in sorted(os.listdir(store_dir)):
+		if file_name.startswith(prefix) and file_name.endswith('.npy') and file_name != data_file:
+			try:
+				os.remove(os.path.join(store_dir, file_name))
+				removed.append(file_name)
+			except OSError:
+				pass
+	return removed
+
+class MaterialStore(object):
+	"""Read access to a compiled store, see compile_store.
+		The index is read on first use, the data array is memory-mapped and every
+		material is sliced out only when it is requested.
+
+		Parameters:
+			source_dir: folder with the mat_*.xlsx files
+			store_path: path prefix of the store, defaults to source_dir/compiled_store
+	"""
+	def __init__(self, source_dir = SOURCE_DIR, store_path = None):
+		super(MaterialStore, self).__init__()
+		self.source_dir = source_dir
+		self.store_path = store_path or os.path.join(source_dir, STORE_NAME)
+		self._index = None
+		self._data = None
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state['_index'] = None
+		state['_data'] = None
+		return state
+
+	@property
+	def index(self):
+		if self._index is None:
+			with open(self.store_path + '.json') as f:
+				self._index = json.load(f)
+		return self._index
+
+	def is_stale(self, material_key = None):
+		'''
+			parameters
+				material_key (list) : materials to check, all source files if None
+
+			return
+				True if the store is missing or any checked source file changed since compilation
+		'''
+		if not os.path.exists(self.store_path + '.json'):
+			return True
+		sources = _source_files(self.source_dir)
+		compiled = self.index['materials']
+		if material_key is None:
+			if set(sources) != set(compiled):
+				return True
+			material_key = list(sources)
+		touched = {}
+		for name in material_key:
+			if name not in sources:
+				continue
+			if name not in compiled:
+				return True
+			stat = os.stat(sources[name])
+			entry = compiled[name]
+			if stat.st_mtime_ns == entry['mtime_ns'] and stat.st_size == entry['size']:
+				continue
+			# touched: only a content change makes the store stale
+			if stat.st_size != entry['size'] or _file_hash(sources[name]) != entry['sha1']:
+				return True
+			touched[name] = stat.st_mtime_ns
+		if touched:
+			self._record_mtimes(touched)
+		return False
+
+	def _record_mtimes(self, mtimes):
+		'''
+			writes the mtimes of touched but unchanged source files back to the index, so they are not hashed again
+		'''
+		index = self.index
+		for name, mtime_ns in mtimes.items():
+			index['materials'][name]['mtime_ns'] = mtime_ns
+		index_path = self.store_path + '.json'
+		tmp_path = index_path + '.tmp%d' % os.getpid()
+		try:
+			with open(tmp_path, 'w') as f:
+				json.dump(index, f, indent=4)
+			os.replace(tmp_path, index_path)
+		except OSError:
+			# read-only store: the files are simply hashed again next time
+			pass
+
+	def ensure(self, material_key = None):
+		'''
+			recompiles the store if it is stale for material_key
+		'''
+		if self.is_stale(material_key):
+			compile_store(self.source_dir, self.store_path)
+			self._index = None
+			self._data = None
+		return self
+
+	def __contains__(self, name):
+		return name in self.index['materials']
+
+	def load(self, name):
+		'''
+			return
+				(wavelength, n, k) arrays, views into the memory-mapped store
+		'''
+		if self._data is None:
+			data_path = os.path.join(os.path.dirname(self.store_path), self.index['data_file'])
+			self._data = np.load(data_path, mmap_mode='r')
+		entry = self.index['materials'][name]
+		block = self._data[entry['offset']:entry['offset'] + entry['length']]
+		return (block[:, 0], block[:, 1], block[:, 2])
+
+def fit_models(material_key = None, model = 'auto', source_dir = SOURCE_DIR, save = True):
+	"""Fits a dispersion model (see dispersion.MODELS) to the tabulated data of every material and
+	stores the coefficients, with the sha1 of the source file they were fitted to, in source_dir/compiled_store.models.json.
+
+		Parameters:
+			material_key: materials to fit, all mat_*.xlsx files if None
+			model: model name, 'auto' for the best candidate, or a dict material name -> model name
+			source_dir: folder with the mat_*.xlsx files
+			save: merge the fits into source_dir/compiled_store.models.json
+
+		return
+			dict : material name -> fit result (model, params, range, fit quality, sha1)
+	"""
+	sources = _source_files(source_dir)
+	material_key = list(sources) if material_key is None else material_key
+	store = MaterialStore(source_dir).ensure(material_key)
+	fits = {}
+	for name in material_key:
+		wv, n, k = store.load(name)
+		fits[name] = dispersion.fit(wv, n, k, model.get(name, 'auto') if isinstance(model, dict) else model)
+		fits[name]['sha1'] = store.index['materials'][name]['sha1']
+	if save:
+		models = load_models(source_dir)
+		models.update(fits)
+		path = os.path.join(source_dir, MODELS_NAME)
+		tmp_path = path + '.tmp%d' % os.getpid()
+		with open(tmp_path, 'w') as f:
+			json.dump(models, f, indent=4)
+		os.replace(tmp_path, path)
+	return fits
+
+def load_models(source_dir = SOURCE_DIR):
+	path = os.path.join(source_dir, MODELS_NAME)
+	if not os.path.exists(path):
+		return {}
+	with open(path) as f:
+		return json.load(f)
+
+class _LazyMaterials(dict):
+	'''
+		material name -> (wavelength, n, k), loaded from the store on first access
+	'''
+	def __init__(self, store):
+		super(_LazyMaterials, self).__init__()
+		self.store = store
+
+	def __missing__(self, name):
+		if name not in self.store:
+			print('The material database does not contain', name)
+			raise KeyError(name)
+		self[name] = self.store.load(name)
+		return self[name]
 
 class MatDatabase(object):
 	"""docstring for MatDatabase
 		Parameters: 
 			material_key: list of material names
+			use_store: read the compiled store (rebuilt when the xlsx sources change) instead of parsing the xlsx files
+			source_dir: folder with the mat_*.xlsx files
+			models: analytic dispersion models used instead of the tables, None (tables only), 'auto' (every
+				material) or a dict material name -> model name or 'auto'. Coefficients are read from
+				source_dir/compiled_store.models.json and refitted when missing, of another model or fitted to other data.
 	"""
-	def __init__(self, material_key):
+	def __init__(self, material_key, use_store = True, source_dir = SOURCE_DIR, models = None):
 		super(MatDatabase, self).__init__()
 		self.material_key = material_key
 		self.num_materials = len(material_key)
+		self.use_store = use_store
+		self.source_dir = source_dir
 		self.mat_database = self.build_database()
+		self._table_cache = LRUCache(maxsize=8)
+		self._interp_cache = LRUCache(maxsize=32)
+		self.models = self.build_models(models)
+
+	def build_models(self, models):
+		'''
+			return
+				dict : material name -> fit result, for the materials evaluated with a dispersion model
+		'''
+		if not models:
+			return {}
+		requested = {name: 'auto' for name in self.material_key} if models in ['auto', True] else dict(models)
+		stored = load_models(self.source_dir)
+		sha1 = {name: _file_hash(path) for name, path in _source_files(self.source_dir).items() if name in requested}
+		stale = {name: model for name, model in requested.items()
+				 if name not in stored or stored[name].get('sha1') != sha1.get(name) or model not in ['auto', stored[name]['model']]}
+		if stale:
+			stored.update(fit_models(list(stale), stale, self.source_dir))
+		return {name: stored[name] for name in requested}
 
 	def build_database(self):
+		if self.use_store:
+			store = MaterialStore(self.source_dir).ensure(self.material_key)
+			for name in self.material_key:
+				if name not in store:
+					print('The material database does not contain', name)
+			return _LazyMaterials(store)
+
 		mat_database = {}
 		
 		#%% Read in the dispersion data of each material
 		for i in range(self.num_materials):
-			file_name = './material_database/mat_' + self.material_key[i] + '.xlsx'
+			file_name = os.path.join(self.source_dir, 'mat_' + self.material_key[i] + '.xlsx')
 			
 			try: 
-				A = np.array(pd.read_excel(file_name))
-				mat_database[self.material_key[i]] = (A[:, 0], A[:, 1], A[:, 2])
-			except NameError:
+				mat_database[self.material_key[i]] = read_xlsx(file_name)
+			except (NameError, FileNotFoundError):
 				print('The material database does not contain', self.material_key[i])
 
 		return mat_database
 
-
-	def interp_wv(self, wv_in, material_key, ignoreloss = False):
+	def interp_wv(self, wv_in, material_key, ignoreloss = False, device = None, dtype = torch.float32):
 		'''
 			parameters
 				wv_in (tensor) : number of wavelengths
 				material_key (list) : number of materials
+				ignoreloss (bool) : drop the extinction coefficient
+				device : device of the result, defaults to the device of wv_in
+				dtype : real dtype of the result
+
+			return
+				refractive indices (complex tensor) : number of materials x number of wavelengths
+
+			Results are memoized per (materials, wavelength grid, ignoreloss, device, dtype);
+			treat them as read-only.
+		'''
+		device = wv_in.device if device is None else torch.device(device)
+		key = (tuple(material_key), tensor_key(wv_in), ignoreloss, str(device), dtype)
+		return self._interp_cache.get_or_create(key, lambda: self._interp(wv_in, material_key, ignoreloss, device, dtype))
+
+	def model_wv(self, wv_in, material_key, ignoreloss = False, dtype = torch.float32, check_range = False):
+		'''
+			closed-form dispersion models of material_key (all of them need a model) evaluated on the
+			device of wv_in, without memoization or host round trips. Wavelengths outside the fitted range
+			of a material are clamped to it; check_range also warns about them (one host sync).
 
 			return
-				refractive indices (tensor or tuple of tensor) : number of materials x number of wavelengths
+				refractive indices (complex tensor) : number of materials x number of wavelengths
 		'''
-		n_data = np.zeros((len(material_key), wv_in.size(0)), dtype=np.float32)
-		k_data = np.zeros((len(material_key), wv_in.size(0)), dtype=np.float32)
-		for i in range(len(material_key)):
-			mat = self.mat_database[material_key[i]]
-			n_data[i, :] = np.interp(wv_in, mat[0], mat[1])
-			k_data[i, :] = np.interp(wv_in, mat[0], mat[2])
+		wv = wv_in.detach().to(dtype).view(-1)
+		return torch.stack([dispersion.evaluate(self.models[name]['model'], self._model_params(name, wv.device, dtype), wv, ignoreloss,
+												self.models[name]['range'], check_range)
+							for name in material_key])
+
+	def _model_params(self, name, device, dtype):
+		return self._table_cache.get_or_create(('model', name, str(device), dtype),
+											   lambda: torch.tensor(self.models[name]['params'], dtype=dtype, device=device))
+
+	def _interp(self, wv_in, material_key, ignoreloss, device, dtype):
+		'''
+			materials with a dispersion model are evaluated in closed form, the others interpolated from their tables
+		'''
+		tabulated = [name for name in material_key if name not in self.models]
+		if len(tabulated) == len(material_key):
+			return self._interp_batched(wv_in, material_key, ignoreloss, device, dtype)
+		table = iter(self._interp_batched(wv_in, tabulated, ignoreloss, device, dtype)) if tabulated else iter([])
+		modeled = self.model_wv(wv_in.to(device), [name for name in material_key if name in self.models], ignoreloss, dtype, check_range = True)
+		modeled = iter(modeled)
+		return torch.stack([next(modeled) if name in self.models else next(table) for name in material_key])
+
+	def _tables(self, material_key, device, dtype):
+		'''
+			return
+				wv (tensor) : number of materials x max table length, padded with inf
+				nk (tensor) : 2 x number of materials x max table length, n and k padded with their last value
+				last (tensor) : number of materials x 1, index of the last valid entry
+		'''
+		def build():
+			tables = [self.mat_database[name] for name in material_key]
+			length = max(len(table[0]) for table in tables)
+			wv = np.full((len(tables), length), np.inf)
+			nk = np.zeros((2, len(tables), length))
+			last = np.zeros((len(tables), 1), dtype=np.int64)
+			for i, table in enumerate(tables):
+				l = len(table[0])
+				wv[i, :l] = table[0]
+				nk[0, i, :] = table[1][-1]
+				nk[1, i, :] = table[2][-1]
+				nk[0, i, :l] = table[1]
+				nk[1, i, :l] = table[2]
+				last[i] = l - 1
+			return (torch.tensor(wv, dtype=dtype, device=device), torch.tensor(nk, dtype=dtype, device=device),
+					torch.tensor(last, device=device))
+		return self._table_cache.get_or_create((tuple(material_key), str(device), dtype), build)
+
+	def _interp_batched(self, wv_in, material_key, ignoreloss, device, dtype):
+		'''
+			linear interpolation of n and k of all materials at once, clamped to the end values like np.interp
+		'''
+		wv, nk, last = self._tables(material_key, device, dtype)
+		x = wv_in.detach().to(device=device, dtype=dtype).view(1, -1).expand(wv.size(0), -1).contiguous()
+
+		idx = torch.searchsorted(wv, x, right=True)
+		idx = torch.minimum(idx.clamp(min=1), last)
+		x0 = torch.gather(wv, 1, idx - 1)
+		x1 = torch.gather(wv, 1, idx)
+		t = ((x - x0) / torch.where(x1 > x0, x1 - x0, torch.ones_like(x0))).clamp(0, 1)
+
+		idx = idx.unsqueeze(0).expand(2, -1, -1)
+		y0 = torch.gather(nk, 2, idx - 1)
+		y1 = torch.gather(nk, 2, idx)
+		n_data, k_data = y0 + t * (y1 - y0)
 
 		if ignoreloss:
-			return torch.complex(torch.tensor(n_data), torch.zeros_like(k_data))
+			return torch.complex(n_data, torch.zeros_like(k_data))
 		else:
-			return torch.complex(torch.tensor(n_data), torch.tensor(k_data))
-		
\ No newline at end of file
+			return torch.complex(n_data, k_data)
+
+def benchmark(material_key, repeat = 3, source_dir = SOURCE_DIR):
+	"""Cold-start time of building a MatDatabase and touching every material, xlsx vs compiled store"""
+	MaterialStore(source_dir).ensure()
+	timings = {}
+	for use_store in [False, True]:
+		best = float('inf')
+		for _ in range(repeat):
+			start = time.perf_counter()
+			database = MatDatabase(material_key, use_store, source_dir)
+			for name in material_key:
+				database.mat_database[name]
+			best = min(best, time.perf_counter() - start)
+		timings['store' if use_store else 'xlsx'] = best
+	return timings
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Compiled material store')
+	parser.add_argument('command', choices=['build', 'bench', 'fit', 'clean'])
+	parser.add_argument('--source_dir', default=SOURCE_DIR)
+	parser.add_argument('--repeat', type=int, default=3)
+	parser.add_argument('--materials', nargs='+')
+	parser.add_argument('--model', default='auto', choices=['auto'] + list(dispersion.MODELS))
+	args = parser.parse_args()
+
+	if args.command == 'build':
+		print('Compiled store written to', compile_store(args.source_dir))
+	elif args.command == 'clean':
+		removed = cleanup_store(args.source_dir)
+		print('Removed {} stale data file(s)'.format(len(removed)), *removed)
+	elif args.command == 'fit':
+		print(dispersion.fit_report(fit_models(args.materials, args.model, args.source_dir)))
+	else:
+		materials = list(_source_files(args.source_dir))
+		timings = benchmark(materials, args.repeat, args.source_dir)
+		print('{} materials, best of {}'.format(len(materials), args.repeat))
+		print('xlsx : {:.3f} s'.format(timings['xlsx']))
+		print('store: {:.3f} s ({:.1f}x)'.format(timings['store'], timings['xlsx'] / timings['store']))
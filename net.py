@@ -2,6 +2,11 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+def _database(params, n_database):
+    # material databases follow params.precision when it is set
+    precision = getattr(params, 'precision', None)
+    return n_database if precision is None else precision.complex(n_database)
+
 class Generator(nn.Module):
     def __init__(self, params):
         super().__init__()
@@ -13,10 +18,10 @@ class Generator(nn.Module):
         self.M_materials = params.M_materials
         self.sensor = params.sensor
         if self.sensor:
-            self.n_database_full = params.n_database_full.view(1, 1, params.M_materials, -1) # 1 x 1 x number of mat x number of freq
-            self.n_database_empty = params.n_database_empty.view(1, 1, params.M_materials, -1) # 1 x 1 x number of mat x number of freq
+            self.n_database_full = _database(params, params.n_database_full).view(1, 1, params.M_materials, -1) # 1 x 1 x number of mat x number of freq
+            self.n_database_empty = _database(params, params.n_database_empty).view(1, 1, params.M_materials, -1) # 1 x 1 x number of mat x number of freq
         else:
-           self.n_database = params.n_database.view(1, 1, params.M_materials, -1) # 1 x 1 x number of mat x number of freq
+           self.n_database = _database(params, params.n_database).view(1, 1, params.M_materials, -1) # 1 x 1 x number of mat x number of freq
                 
         self.FC = nn.Sequential(
             nn.Linear(self.noise_dim, self.N_layers * (self.M_materials + 1)),
@@ -81,10 +86,10 @@ class ResGenerator(nn.Module):
         self.M_materials = params.M_materials
         self.sensor = params.sensor
         if self.sensor:
-            self.n_database_full = params.n_database_full.view(1, 1, params.M_materials, -1) # 1 x 1 x number of mat x number of freq
-            self.n_database_empty = params.n_database_empty.view(1, 1, params.M_materials, -1) # 1 x 1 x number of mat x number of freq
+            self.n_database_full = _database(params, params.n_database_full).view(1, 1, params.M_materials, -1) # 1 x 1 x number of mat x number of freq
+            self.n_database_empty = _database(params, params.n_database_empty).view(1, 1, params.M_materials, -1) # 1 x 1 x number of mat x number of freq
         else:
-           self.n_database = params.n_database.view(1, 1, params.M_materials, -1) # 1 x 1 x number of mat x number of freq
+           self.n_database = _database(params, params.n_database).view(1, 1, params.M_materials, -1) # 1 x 1 x number of mat x number of freq
                 
         self.initBLOCK = nn.Sequential(
             nn.Linear(self.noise_dim, self.res_dim),
@@ -0,0 +1,164 @@
+import torch
+
+def design_fom(glonet, result_mat, kvector=None, inc_angles=None, pol=None, target=None):
+    """Figure of merit of discrete designs (lower is better), as used by the notebooks to rank them.
+
+    Args:
+        glonet: trained GLOnet, provides the materials, solver backend and sensor response
+        result_mat: (tensor) number of designs x number of layers, material indices
+        kvector, inc_angles, pol: evaluation grid, defaults to the training grid
+        target: 1 x number of frequencies x number of angles x (number of pol or 1), defaults to glonet.target_reflection
+
+    Returns:
+        fom(thicknesses, rows): number of rows, for the designs result_mat[rows] with the given thicknesses
+    """
+    kvector = glonet.k if kvector is None else glonet.to_cuda_if_available(kvector).type(glonet.dtype)
+    inc_angles = glonet.theta if inc_angles is None else glonet.to_cuda_if_available(inc_angles).type(glonet.dtype)
+    pol = glonet.pol if pol is None else pol
+
+    if glonet.sensor:
+        ref_idx_empty, ref_idx_full = glonet._calculate_refractive_indices(result_mat, kvector)
+
+        def fom(thicknesses, rows):
+            reflection_empty = glonet._solve(thicknesses, ref_idx_empty[rows], kvector, inc_angles, pol)
+            reflection_full = glonet._solve(thicknesses, ref_idx_full[rows], kvector, inc_angles, pol)
+            signal = glonet.sensor_signal(kvector, reflection_empty, reflection_full)
+            return torch.pow(signal - 1, 2).view(thicknesses.size(0), -1).mean(dim=1)
+        return fom
+
+    ref_idx = glonet._design_refractive_indices(None, None, result_mat, kvector, grayscale=False)
+    target = glonet.target_reflection if target is None else glonet.to_cuda_if_available(target)
+
+    def fom(thicknesses, rows):
+        reflection = glonet._solve(thicknesses, ref_idx[rows], kvector, inc_angles, pol)
+        return torch.mean(torch.pow(reflection - target, 2), dim=(1, 2, 3))
+    return fom
+
+
+def polish_designs(glonet, thicknesses, result_mat, top_k=10, method='adam', max_iter=200, lr=None, patience=20,
+                   tol=1e-4, lbfgs_steps=10, kvector=None, inc_angles=None, pol=None, target=None):
+    """Local refinement of the best evaluated designs: the materials stay fixed and only the
+    thicknesses are optimized, inside [thickness_l, thickness_sup], for all top_k designs in one
+    batched problem. A design stops once its FoM has not improved by a relative tol for patience
+    iterations; only the designs still running are solved.
+
+    Example:
+    ```
+    thicknesses, refractive_indices, result_mat, reflection = glonet.evaluate(100, grayscale=False)
+    polished = polish_designs(glonet, thicknesses, result_mat, top_k=10, method='lbfgs')
+    best = polished['thicknesses'][0], polished['result_mat'][0]
+    ```
+
+    Args:
+        method: 'adam' (projected onto the box after every step) or 'lbfgs' (box through
+            thickness = thickness_l + (thickness_sup - thickness_l) * sigmoid(u), early stopping
+            checked after every lbfgs_steps inner iterations)
+        max_iter: optimizer steps ('adam') or outer steps ('lbfgs')
+        lr: step size, 1e-3 (thickness units) for 'adam' and 1 for 'lbfgs' if None
+        others: see design_fom
+
+    Returns:
+        (dict) 'thicknesses', 'result_mat', 'fom', 'fom_initial' sorted by polished FoM,
+        'indices' of the designs in the inputs and 'iterations' run by each of them
+    """
+    thickness_l = glonet.generator.thickness_l
+    thickness_sup = glonet.generator.thickness_sup
+    fom = design_fom(glonet, result_mat, kvector, inc_angles, pol, target)
+
+    # top-K by FoM of the unpolished designs
+    with torch.no_grad():
+        rows = torch.arange(thicknesses.size(0), device=thicknesses.device)
+        fom_all = fom(thicknesses.detach(), rows)
+        fom_initial, indices = torch.topk(fom_all, min(top_k, fom_all.numel()), largest=False)
+    fom_fn = lambda d, active: fom(d, indices[active])
+
+    start = thicknesses.detach()[indices].clamp(thickness_l, thickness_sup)
+    if method == 'lbfgs':
+        lr = 1. if lr is None else lr
+        best, best_fom, iterations = _polish_lbfgs(fom_fn, start, fom_initial, thickness_l, thickness_sup, max_iter, lr, patience, tol, lbfgs_steps)
+    else:
+        lr = 1e-3 if lr is None else lr
+        best, best_fom, iterations = _polish_adam(fom_fn, start, fom_initial, thickness_l, thickness_sup, max_iter, lr, patience, tol)
+
+    order = torch.argsort(best_fom)
+    return {'thicknesses': best[order], 'result_mat': result_mat[indices][order], 'fom': best_fom[order],
+            'fom_initial': fom_initial[order], 'indices': indices[order], 'iterations': iterations[order]}
+
+
+class _EarlyStopping(object):
+    '''
+    best thicknesses and FoM of every design, and which designs are still improving
+    '''
+    def __init__(self, start, fom_initial, patience, tol):
+        self.best = start.clone()
+        self.best_fom = fom_initial.clone()
+        self.stale = torch.zeros_like(fom_initial, dtype=torch.long)
+        self.iterations = torch.zeros_like(fom_initial, dtype=torch.long)
+        self.active = torch.ones_like(fom_initial, dtype=torch.bool)
+        self.patience = patience
+        self.tol = tol
+
+    def update(self, thicknesses, fom_active):
+        active = self.active.nonzero().squeeze(1)
+        improved = fom_active < self.best_fom[active] * (1 - self.tol)
+        better = fom_active < self.best_fom[active]
+        self.best[active[better]] = thicknesses[active[better]]
+        self.best_fom[active[better]] = fom_active[better]
+        self.stale[active] = torch.where(improved, torch.zeros_like(self.stale[active]), self.stale[active] + 1)
+        self.iterations[active] += 1
+        self.active[active[self.stale[active] >= self.patience]] = False
+        return bool(self.active.any())
+
+
+def _polish_adam(fom_fn, start, fom_initial, thickness_l, thickness_sup, max_iter, lr, patience, tol):
+    thicknesses = start.clone().requires_grad_(True)
+    optimizer = torch.optim.Adam([thicknesses], lr=lr)
+    stopping = _EarlyStopping(start, fom_initial, patience, tol)
+
+    for _ in range(max_iter):
+        active = stopping.active.clone()
+        optimizer.zero_grad()
+        # FoMs are summed, so every design only receives the gradient of its own FoM
+        fom_active = fom_fn(thicknesses[active], active)
+        fom_active.sum().backward()
+        if not stopping.update(thicknesses.detach(), fom_active.detach()):
+            break
+        optimizer.step()
+        with torch.no_grad():
+            thicknesses.clamp_(thickness_l, thickness_sup)
+            # stopped designs keep their best thicknesses even though Adam's momentum still moves them
+            stopped = ~stopping.active
+            thicknesses[stopped] = stopping.best[stopped]
+    return stopping.best, stopping.best_fom, stopping.iterations
+
+
+def _polish_lbfgs(fom_fn, start, fom_initial, thickness_l, thickness_sup, max_iter, lr, patience, tol, lbfgs_steps):
+    scale = thickness_sup - thickness_l
+    fraction = ((start - thickness_l) / scale).clamp(1e-6, 1 - 1e-6)
+    u = torch.log(fraction / (1 - fraction)).requires_grad_(True)
+    to_thicknesses = lambda u: thickness_l + scale * torch.sigmoid(u)
+    optimizer = torch.optim.LBFGS([u], lr=lr, max_iter=lbfgs_steps, line_search_fn='strong_wolfe')
+    stopping = _EarlyStopping(start, fom_initial, patience, tol)
+
+    previous = None
+    for _ in range(max_iter):
+        active = stopping.active.clone()
+        u_stopped = u.detach()[~active].clone()
+        # curvature pairs recorded while stopped designs were still moving would mix frozen and active coordinates
+        if previous is not None and not torch.equal(active, previous):
+            optimizer.state.clear()
+        previous = active
+
+        def closure():
+            optimizer.zero_grad()
+            loss = fom_fn(to_thicknesses(u)[active], active).sum()
+            loss.backward()
+            return loss
+
+        optimizer.step(closure)
+        with torch.no_grad():
+            u[~active] = u_stopped
+            thicknesses = to_thicknesses(u)
+            if not stopping.update(thicknesses, fom_fn(thicknesses[active], active)):
+                break
+    return stopping.best, stopping.best_fom, stopping.iterations
@@ -0,0 +1,51 @@
+import torch
+
+class PrecisionPolicy(object):
+    """Real and complex dtypes used end to end: generator material databases, MatDatabase.interp_wv
+    and the TMM solvers. Inputs are cast once when they enter the solver; the reflection comes
+    out in real_dtype.
+
+    Example:
+    ```
+    params.precision = PrecisionPolicy.training()       # float32 / complex64
+    params.precision = PrecisionPolicy.verification()   # float64 / complex128
+    params.precision = PrecisionPolicy.training(boundary_dtype=torch.complex128)
+    ```
+
+    Args:
+        real_dtype: thicknesses, wavenumbers, angles and reflection
+        boundary_dtype: complex dtype of the boundary matrices and of the final S matrix, defaults to complex_dtype
+    """
+    def __init__(self, real_dtype=torch.float32, boundary_dtype=None):
+        self.real_dtype = real_dtype
+        self.complex_dtype = torch.complex128 if real_dtype == torch.float64 else torch.complex64
+        self.boundary_dtype = boundary_dtype or self.complex_dtype
+        self.boundary_real_dtype = torch.float64 if self.boundary_dtype == torch.complex128 else torch.float32
+
+    @classmethod
+    def training(cls, boundary_dtype=None):
+        return cls(torch.float32, boundary_dtype)
+
+    @classmethod
+    def verification(cls):
+        return cls(torch.float64)
+
+    def key(self):
+        return (str(self.real_dtype), str(self.boundary_dtype))
+
+    def real(self, tensor):
+        '''
+        casts a real tensor to real_dtype (no copy if it already is)
+        '''
+        return tensor.to(self.real_dtype)
+
+    def complex(self, tensor):
+        '''
+        casts a real or complex tensor to complex_dtype (no copy if it already is)
+        '''
+        return tensor.to(self.complex_dtype)
+
+    def __repr__(self):
+        return 'PrecisionPolicy(real_dtype={}, boundary_dtype={})'.format(self.real_dtype, self.boundary_dtype)
+
+DEFAULT_PRECISION = PrecisionPolicy.training()
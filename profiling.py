@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import resource
+import contextlib
+import torch
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+class NullProfiler(object):
+    """Stand-in used when profiling is disabled: every call is a no-op."""
+    enabled = False
+
+    def phase(self, name):
+        return _NULL_CONTEXT
+
+    def add_hook(self, hook):
+        pass
+
+    def start(self):
+        pass
+
+    def step(self, it, **metrics):
+        pass
+
+    def stop(self):
+        pass
+
+
+class PhaseProfiler(object):
+    """Per-phase instrumentation of a training loop.
+
+    Every `phase(name)` block accumulates wall-clock and CPU time; `step(it)` closes an
+    iteration, passes its metrics to the registered hooks and records memory high-water marks.
+    `stop()` writes a JSON summary (and, if requested, a chrome trace from torch.profiler).
+
+    Example:
+    ```
+    profiler = PhaseProfiler('N8/final/seed_1')
+    profiler.add_hook(lambda metrics: print(metrics['iter'], metrics['phases']['tmm']['wall']))
+    profiler.start()
+    with profiler.phase('tmm'):
+        ...
+    profiler.step(it)
+    profiler.stop()
+    ```
+
+    Args:
+        output_dir: (string) folder of profile.json and trace.json
+        trace: (bool) record a torch.profiler trace of iterations trace_start .. trace_start + trace_iters
+        trace_start: (int) iterations to skip before tracing
+        trace_iters: (int) number of traced iterations
+    """
+    enabled = True
+
+    def __init__(self, output_dir, trace=False, trace_start=2, trace_iters=3):
+        self.output_dir = output_dir
+        self.trace = trace
+        self.trace_start = trace_start
+        self.trace_iters = trace_iters
+        self.cuda = torch.cuda.is_available()
+        self.hooks = []
+        self.totals = {}
+        self.iterations = 0
+        self._current = {}
+        self._torch_profiler = None
+
+    def add_hook(self, hook):
+        '''
+        hook(metrics) is called after every iteration with a dict of iter, phases, memory and the step metrics
+        '''
+        self.hooks.append(hook)
+
+    def start(self):
+        self.totals = {}
+        self.iterations = 0
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time()
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+        if self.trace:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            trace_path = os.path.join(self.output_dir, 'trace.json')
+            self._torch_profiler = torch.profiler.profile(
+                activities=activities, profile_memory=True,
+                schedule=torch.profiler.schedule(wait=self.trace_start, warmup=1, active=self.trace_iters, repeat=1),
+                on_trace_ready=lambda prof: prof.export_chrome_trace(trace_path))
+            os.makedirs(self.output_dir, exist_ok=True)
+            self._torch_profiler.start()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if self.cuda:
+            torch.cuda.synchronize()
+        wall, cpu = time.perf_counter(), time.process_time()
+        with torch.profiler.record_function(name):
+            yield
+        if self.cuda:
+            torch.cuda.synchronize()
+        timing = self._current.setdefault(name, {'wall': 0., 'cpu': 0.})
+        timing['wall'] += time.perf_counter() - wall
+        timing['cpu'] += time.process_time() - cpu
+
+    def memory(self):
+        '''
+        high-water marks in MB: resident set size of the process and, on GPU, allocated device memory
+        '''
+        memory = {'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.}
+        if self.cuda:
+            memory['max_cuda_allocated'] = torch.cuda.max_memory_allocated() / 1024. ** 2
+        return memory
+
+    def step(self, it, **metrics):
+        for name, timing in self._current.items():
+            total = self.totals.setdefault(name, {'wall': 0., 'cpu': 0., 'max_wall': 0.})
+            total['wall'] += timing['wall']
+            total['cpu'] += timing['cpu']
+            total['max_wall'] = max(total['max_wall'], timing['wall'])
+        self.iterations += 1
+
+        if self.hooks:
+            metrics = dict(metrics, iter=it, phases=self._current, memory=self.memory())
+            for hook in self.hooks:
+                hook(metrics)
+        self._current = {}
+
+        if self._torch_profiler is not None:
+            self._torch_profiler.step()
+
+    def summary(self):
+        iterations = max(self.iterations, 1)
+        phases = {name: {'wall_total': total['wall'], 'cpu_total': total['cpu'],
+                         'wall_mean': total['wall'] / iterations, 'cpu_mean': total['cpu'] / iterations,
+                         'wall_max': total['max_wall']}
+                  for name, total in self.totals.items()}
+        return {'iterations': self.iterations,
+                'wall_total': time.perf_counter() - self._start_wall,
+                'cpu_total': time.process_time() - self._start_cpu,
+                'phases': phases,
+                'memory': self.memory()}
+
+    def stop(self):
+        if self._torch_profiler is not None:
+            self._torch_profiler.stop()
+            self._torch_profiler = None
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(os.path.join(self.output_dir, 'profile.json'), 'w') as f:
+            json.dump(self.summary(), f, indent=4)
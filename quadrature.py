@@ -0,0 +1,97 @@
+import math
+import numpy as np
+import torch
+from sensor import trapezoid_weights
+
+def gauss_legendre(n, a, b):
+    '''
+    n point Gauss-Legendre rule on [a, b], exact for polynomials of degree 2n - 1
+
+    return:
+        nodes, weights (ndarray): n, nodes in increasing order
+    '''
+    nodes, weights = np.polynomial.legendre.leggauss(n)
+    return (b - a) / 2 * nodes + (a + b) / 2, (b - a) / 2 * weights
+
+def clenshaw_curtis(n, a, b):
+    '''
+    n point Clenshaw-Curtis rule on [a, b] (n >= 2), nodes include the end points
+
+    return:
+        nodes, weights (ndarray): n, nodes in increasing order
+    '''
+    N = n - 1
+    j = np.arange(n)
+    nodes = -np.cos(np.pi * j / N)
+    weights = np.ones(n)
+    for m in range(1, N // 2 + 1):
+        b_m = 1. if 2 * m == N else 2.
+        weights -= b_m / (4 * m * m - 1) * np.cos(2 * m * np.pi * j / N)
+    weights *= np.where((j == 0) | (j == N), 1., 2.) / N
+    return (b - a) / 2 * nodes + (a + b) / 2, (b - a) / 2 * weights
+
+def trapezoid(n, a, b):
+    '''
+    n evenly spaced points on [a, b] with trapezoid weights, the grids of the notebooks
+    '''
+    nodes = np.linspace(a, b, n)
+    return nodes, trapezoid_weights(nodes)
+
+RULES = {'gauss': gauss_legendre, 'clenshaw_curtis': clenshaw_curtis, 'trapezoid': trapezoid}
+
+def quadrature(n, a, b, rule = 'gauss', dtype = torch.float64):
+    '''
+    args:
+        n (int): number of nodes
+        a, b (float): integration interval
+        rule (str): 'gauss', 'clenshaw_curtis' or 'trapezoid'
+
+    return:
+        nodes, weights (tensor): n
+    '''
+    nodes, weights = RULES[rule](n, a, b)
+    return torch.from_numpy(nodes).type(dtype), torch.from_numpy(weights).type(dtype)
+
+def wavelength_grid(n, lambda_min, lambda_max, rule = 'gauss', dtype = torch.float64):
+    '''
+    wavenumber grid for params.k with the weights of the integral over wavelength (params.k_weights)
+
+    return:
+        k, k_weights (tensor): n, k = 2 pi / lambda at the quadrature nodes in lambda
+    '''
+    lambdas, weights = quadrature(n, lambda_min, lambda_max, rule, dtype)
+    return 2 * math.pi / lambdas, weights
+
+def angle_grid(n, theta_max = math.pi / 2, rule = 'gauss', dtype = torch.float64):
+    '''
+    incidence angles on [0, theta_max] for params.theta with their weights (params.theta_weights)
+    '''
+    return quadrature(n, 0., theta_max, rule, dtype)
+
+def hemispherical_reflection(reflection, theta, theta_weights = None):
+    '''
+    average of the reflection over the incidence angles with the hemispherical measure sin(2 theta) dtheta,
+    and over polarizations: sum_theta w R sin(2 theta) / sum_theta w sin(2 theta)
+
+    args:
+        reflection (tensor): batch size x number of frequencies x number of angles x number of pol
+        theta (tensor): number of angles
+        theta_weights (tensor): number of angles, quadrature weights of theta, trapezoid weights if None
+
+    return:
+        (tensor) batch size x number of frequencies
+    '''
+    if theta_weights is None:
+        theta_weights = torch.from_numpy(trapezoid_weights(theta.detach().cpu().double().numpy()))
+    theta = theta.to(reflection.device, torch.float64).view(-1)
+    weights = theta_weights.to(reflection.device, torch.float64) * torch.sin(2 * theta)
+    weights = (weights / weights.sum()).to(reflection.dtype)
+    return torch.sum(reflection.mean(dim=3) * weights.view(1, 1, -1), dim=2)
+
+def band_integral(values, k_weights, dim = 1):
+    '''
+    integral over wavelength of values along dim with the quadrature weights k_weights (number of frequencies)
+    '''
+    shape = [1] * values.dim()
+    shape[dim] = -1
+    return torch.sum(values * k_weights.to(values.device, values.dtype).view(shape), dim=dim)
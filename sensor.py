@@ -0,0 +1,91 @@
+import math
+import numpy as np
+import pandas as pd
+import torch
+from scipy.interpolate import UnivariateSpline
+from cache import LRUCache, tensor_key
+
+def create_spline(filename):
+    df = pd.read_csv(filename, sep=';', decimal=',')
+    df.columns = ['Wavelength [nm]', 'Reflection spectra']
+    spline = UnivariateSpline(df['Wavelength [nm]'] / 1000, df['Reflection spectra'])
+    spline.set_smoothing_factor(0.006)
+    return spline
+
+def trapezoid_weights(x):
+    '''
+    args:
+        x (ndarray): sample points
+
+    return:
+        weights (ndarray) such that sum(weights * y) == trapz(y, x)
+    '''
+    dx = np.diff(x)
+    weights = np.zeros_like(x)
+    weights[:-1] += dx / 2
+    weights[1:] += dx / 2
+    return weights
+
+class SpectralResponse(object):
+    """LED x LDR response of the sensor, reduced to one weight per frequency.
+
+    The splines are evaluated once per wavenumber grid; the integration weights (trapezoid, or the
+    quadrature weights of the grid over wavelength, see quadrature.py), the LED x LDR product and
+    the LED integral used for normalization are cached on the grid's device.
+
+    Example:
+    ```
+    response = SpectralResponse()
+    signal = response.signal(k, reflection_empty, reflection_full)
+    ```
+    """
+    def __init__(self, led_file="true-green-osram.csv", ldr_file="ldr.csv", maxsize=8):
+        self.led_spline = create_spline(led_file)
+        self.ldr_spline = create_spline(ldr_file)
+        self._weights = LRUCache(maxsize)
+
+    def weights(self, k, k_weights = None):
+        '''
+        args:
+            k (tensor): number of frequencies
+            k_weights (tensor): number of frequencies, quadrature weights over wavelength, trapezoid rule if None
+
+        return:
+            weights (tensor): number of frequencies, integration weights x LED x LDR
+            norm (float): integral of the LED spectrum on the same grid
+        '''
+        key = tensor_key(k) if k_weights is None else (tensor_key(k), tensor_key(k_weights))
+        return self._weights.get_or_create(key, lambda: self._build_weights(k, k_weights))
+
+    def _build_weights(self, k, k_weights = None):
+        lambdas = (2 * math.pi / k).detach().cpu().double().numpy()
+        if k_weights is None:
+            integration = trapezoid_weights(lambdas)
+        else:
+            integration = k_weights.detach().cpu().double().numpy()
+        led = self.led_spline(lambdas)
+        weights = torch.from_numpy(integration * led * self.ldr_spline(lambdas)).to(k.device)
+        norm = float(np.sum(integration * led))
+        return weights, norm
+
+    def signal(self, k, reflection_empty, reflection_full, k_weights = None):
+        '''
+        args:
+            k (tensor): number of frequencies
+            reflection_empty, reflection_full (tensor): batch size x number of frequencies x number of angles x number of pol
+            k_weights (tensor): number of frequencies, quadrature weights over wavelength, trapezoid rule if None
+
+        return:
+            sensor signal (tensor): batch size (x number of angles x number of pol if not 1)
+        '''
+        return self.apply(self.weights(k, k_weights), reflection_empty, reflection_full)
+
+    @staticmethod
+    def apply(weights, reflection_empty, reflection_full):
+        '''
+        signal from weights = (weights, norm) returned by SpectralResponse.weights, for callers that keep them
+        for their grid instead of looking them up (which hashes k) on every call
+        '''
+        weights, norm = weights
+        signal_diff = torch.sum((reflection_empty - reflection_full) * weights.to(reflection_empty.dtype).view(1, -1, 1, 1), dim=1)
+        return (torch.abs(signal_diff) / norm).squeeze(-1).squeeze(-1)
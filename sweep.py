@@ -0,0 +1,146 @@
+import os
+import copy
+import json
+import time
+import random
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import torch
+
+def expand_grid(seeds, grid=None):
+    """Cartesian product of seeds and hyperparameter values.
+
+    Args:
+        seeds: iterable of ints
+        grid: (dict) parameter name -> list of values, applied on top of the base Params
+
+    Returns:
+        list of jobs, dicts with 'name', 'group', 'seed' and 'overrides'
+    """
+    grid = grid or {}
+    names = sorted(grid)
+    jobs = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        overrides = dict(zip(names, values))
+        group = '_'.join('{}={}'.format(name, value) for name, value in overrides.items()) or 'base'
+        for seed in seeds:
+            jobs.append({'name': '{}/seed_{}'.format(group, seed), 'group': group,
+                         'seed': seed, 'overrides': overrides})
+    return jobs
+
+
+def load_manifest(output_dir):
+    path = os.path.join(output_dir, 'manifest.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, output_dir):
+    """Writes `output_dir/manifest.json` atomically"""
+    path = os.path.join(output_dir, 'manifest.json')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+def _init_worker(threads_per_worker):
+    """Limits the intra-op thread pools of a worker process"""
+    for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        os.environ[var] = str(threads_per_worker)
+    torch.set_num_threads(threads_per_worker)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+
+def run_job(params, job, output_dir):
+    """Trains one (seed, overrides) job, resuming from its checkpoint if one exists.
+
+    The job writes the usual `ruta/seed_N` outputs under `output_dir/<group>`, with periodic
+    (params.checkpoint_iter) and final checkpoints `model.pth.tar` next to them.
+
+    Returns:
+        (dict) manifest record of the job
+    """
+    from GLOnet_thinfilm import GLOnet
+
+    job_params = copy.copy(params)
+    for name, value in job['overrides'].items():
+        setattr(job_params, name, value)
+    job_params.seed = job['seed']
+    job_params.ruta = os.path.join(output_dir, job['group'])
+    seed_dir = os.path.join(job_params.ruta, 'seed_{}'.format(job['seed']))
+    os.makedirs(seed_dir, exist_ok=True)
+
+    torch.manual_seed(job['seed'])
+    random.seed(job['seed'])
+    np.random.seed(job['seed'])
+    glonet = GLOnet(job_params)
+
+    checkpoint_path = os.path.join(seed_dir, 'model.pth.tar')
+    if os.path.exists(checkpoint_path):
+        glonet.resume(checkpoint_path)
+    resumed_from = glonet.iter0
+
+    start = time.time()
+    glonet.train()
+    wall_time = time.time() - start
+
+    glonet.save_checkpoint(glonet.stop_iter)
+    glonet.viz_training()
+    loss_training = [float(loss) for loss in glonet.loss_training]
+
+    return {'status': 'done', 'seed': job['seed'], 'overrides': job['overrides'],
+            'iterations': glonet.stop_iter, 'stop_reason': glonet.stop_reason, 'resumed_from': resumed_from, 'wall_time': wall_time,
+            'final_loss': loss_training[-1] if loss_training else None}
+
+
+def run_sweep(params, seeds, grid=None, output_dir='sweep', workers=None, threads_per_worker=1, checkpoint_iter=50):
+    """Runs a grid of GLOnet trainings over a process pool.
+
+    Jobs recorded as done in `output_dir/manifest.json` are skipped, interrupted jobs resume
+    from their checkpoint, and the manifest is rewritten after every finished job with its
+    timing and final loss.
+
+    Example:
+    ```
+    manifest = run_sweep(params, seeds=range(1, 201), grid={'sigma': [0.04, 0.08]},
+                         output_dir='N8/sweep', workers=8, threads_per_worker=2)
+    ```
+
+    Args:
+        params: (Params) base parameters, as passed to GLOnet
+        seeds: iterable of ints
+        grid: (dict) parameter name -> list of values
+        output_dir: (string) root folder of the sweep
+        workers: (int) number of processes, defaults to cores // threads_per_worker
+        threads_per_worker: (int) torch threads per process
+        checkpoint_iter: (int) iterations between checkpoints of a running job, 0 disables
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    params = copy.copy(params)
+    params.checkpoint_iter = checkpoint_iter
+    params.checkpoint_dir = None
+    workers = workers or max(1, (os.cpu_count() or 1) // threads_per_worker)
+    manifest = load_manifest(output_dir)
+    jobs = [job for job in expand_grid(seeds, grid) if manifest.get(job['name'], {}).get('status') != 'done']
+
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=_init_worker, initargs=(threads_per_worker,)) as pool:
+        futures = {pool.submit(run_job, params, job, output_dir): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                manifest[job['name']] = future.result()
+            except Exception as e:
+                manifest[job['name']] = {'status': 'failed', 'seed': job['seed'],
+                                         'overrides': job['overrides'], 'error': repr(e)}
+            save_manifest(manifest, output_dir)
+    return manifest
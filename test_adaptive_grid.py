@@ -0,0 +1,18 @@
+import math
+import torch
+from adaptive_grid import AdaptiveGrid
+from sensor import trapezoid_weights
+
+def test_refine_with_negative_weights_on_increasing_k():
+    k = torch.linspace(2 * math.pi / 0.8, 2 * math.pi / 0.4, 41, dtype=torch.float64)
+    # trapezoid weights over wavelength of an increasing k grid are all negative
+    weights = torch.from_numpy(trapezoid_weights((2 * math.pi / k).numpy()))
+    assert (weights < 0).all()
+
+    grid = AdaptiveGrid(k, weights = weights, coarse = 0.1, tol = 1e-4)
+    assert (grid.weights >= 0).all() and float(grid.weights.max()) == 1.
+    size = grid.size
+    values = torch.sin(8 * k / k.max()).view(1, -1, 1, 1).expand(2, -1, 1, 1)
+    added = grid.refine(values, normIter = 0.)
+    assert added > 0
+    assert grid.size == size + added
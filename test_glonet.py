@@ -0,0 +1,57 @@
+import math
+import os
+import torch
+from utils import Params
+from material_database import MatDatabase
+from GLOnet_thinfilm import GLOnet
+
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'material_database')
+
+def _params(ruta, **options):
+    params = Params()
+    params.N_layers = 4
+    params.pol = 'TM'
+    params.k = 2 * math.pi / torch.linspace(0.4, 0.8, 12)
+    params.theta = torch.tensor([0.])
+    params.n_top = torch.tensor([1.])
+    params.n_bot = torch.tensor([1.])
+    params.sensor = False
+    params.user_define = False
+    params.materials = ['SiO2', 'TiO2']
+    params.matdatabase = MatDatabase(params.materials, source_dir = SOURCE_DIR)
+    params.n_database = params.matdatabase.interp_wv(2 * math.pi/params.k, params.materials, True)
+    params.M_materials = params.n_database.size(0)
+    params.target_reflection = torch.zeros((1, params.k.size(0), 1, 1))
+    params.thickness_sup = 0.3
+    params.thickness_l = 0.
+    params.alpha_sup = 4
+    params.net = 'Dnn'
+    params.res_layers = 2
+    params.res_dim = 8
+    params.noise_dim = 4
+    params.lr = 0.05
+    params.beta1 = 0.9
+    params.beta2 = 0.99
+    params.weight_decay = 0.001
+    params.step_size = 40000
+    params.numIter = 2
+    params.batch_size = 8
+    params.sigma = 0.2
+    params.ruta = str(ruta)
+    params.seed = 0
+    for name, value in options.items():
+        setattr(params, name, value)
+    return params
+
+def test_evaluate_discrete_uses_design_cache(tmp_path):
+    glonet = GLOnet(_params(tmp_path, design_cache = True))
+    torch.manual_seed(1)
+    glonet.evaluate(6, grayscale = False)
+    first = glonet.design_cache.stats()
+    assert first['misses'] > 0 and first['hits'] == 0
+
+    torch.manual_seed(1)
+    glonet.evaluate(6, grayscale = False)
+    second = glonet.design_cache.stats()
+    assert second['misses'] == first['misses']
+    assert second['hits'] == first['size']
@@ -0,0 +1,43 @@
+import math
+import pytest
+import torch
+from TMM import TMM_solver, TMM_solver_adjoint
+from precision import PrecisionPolicy
+
+PRECISION = PrecisionPolicy.verification()
+
+def _problem(batch_size = 2, N_layers = 4, numfreq = 3, num_angles = 2, seed = 0):
+    generator = torch.Generator().manual_seed(seed)
+    thicknesses = 0.02 + 0.28 * torch.rand(batch_size, N_layers, generator=generator, dtype=torch.float64)
+    n = 1.3 + 1.3 * torch.rand(batch_size, N_layers, numfreq, generator=generator, dtype=torch.float64)
+    kappa = 0.05 * torch.rand(batch_size, N_layers, numfreq, generator=generator, dtype=torch.float64)
+    refractive_indices = torch.complex(n, kappa)
+    k = 2 * math.pi / torch.linspace(0.4, 1.2, numfreq, dtype=torch.float64)
+    theta = torch.linspace(0, math.pi / 2.25, num_angles, dtype=torch.float64)
+    n_bot = torch.tensor([1.], dtype=torch.float64)
+    n_top = torch.tensor([1.46], dtype=torch.float64)
+    return thicknesses, refractive_indices, n_bot, n_top, k, theta
+
+@pytest.mark.parametrize('pol', ['TM', 'TE', 'both'])
+def test_adjoint_gradcheck(pol):
+    thicknesses, refractive_indices, n_bot, n_top, k, theta = _problem()
+    solver = lambda d, n: TMM_solver_adjoint(d, n, n_bot, n_top, k, theta, pol, precision = PRECISION)
+    inputs = (thicknesses.requires_grad_(True), refractive_indices.requires_grad_(True))
+    assert torch.autograd.gradcheck(solver, inputs, eps = 1e-6, atol = 1e-6, rtol = 1e-4)
+
+@pytest.mark.parametrize('pol', ['TM', 'TE', 'both'])
+def test_adjoint_matches_autograd(pol):
+    thicknesses, refractive_indices, n_bot, n_top, k, theta = _problem(3, 6, 5, 3, seed = 1)
+    weights = torch.rand(3, 5, 3, 2 if pol == 'both' else 1, generator=torch.Generator().manual_seed(2), dtype=torch.float64)
+    grads = []
+    reflections = []
+    for solver in [TMM_solver, TMM_solver_adjoint]:
+        d = thicknesses.clone().requires_grad_(True)
+        n = refractive_indices.clone().requires_grad_(True)
+        reflection = solver(d, n, n_bot, n_top, k, theta, pol, precision = PRECISION)
+        (reflection * weights).sum().backward()
+        reflections.append(reflection.detach())
+        grads.append((d.grad, n.grad))
+    torch.testing.assert_close(reflections[1], reflections[0], rtol = 1e-10, atol = 1e-12)
+    for expected, actual in zip(grads[0], grads[1]):
+        torch.testing.assert_close(actual, expected, rtol = 1e-8, atol = 1e-10)
@@ -0,0 +1,155 @@
+import numpy as np
+import torch
+from TMM import TMM_solver_inference, SolverContext, clear_workspaces
+from precision import DEFAULT_PRECISION
+from sensor import trapezoid_weights
+
+# complex values alive per (device, frequency, angle, pol) point during a solve: stack, layer matrix,
+# their product and the admittance / phase temporaries of transfer_matrix_layer
+_VALUES_PER_POINT = 24
+
+def estimate_tile_bytes(batch_size, numfreq, num_angles, num_pol, precision = None):
+    '''
+    rough peak memory of one solve of a batch size x number of frequencies x number of angles x number of pol tile
+    '''
+    precision = precision or DEFAULT_PRECISION
+    itemsize = torch.empty(0, dtype=precision.complex_dtype).element_size()
+    return batch_size * numfreq * num_angles * num_pol * _VALUES_PER_POINT * itemsize
+
+def plan_tiles(batch_size, numfreq, num_angles, num_pol, memory_budget, precision = None):
+    '''
+    largest tile under memory_budget, shrinking devices first, then frequencies, then angles
+
+    return:
+        (devices, frequencies, angles) per tile
+    '''
+    point_bytes = estimate_tile_bytes(1, 1, 1, num_pol, precision)
+    points = max(1, int(memory_budget // point_bytes))
+    angles = min(num_angles, points)
+    freqs = min(numfreq, max(1, points // angles))
+    devices = min(batch_size, max(1, points // (angles * freqs)))
+    return devices, freqs, angles
+
+def open_memmap(path, shape, dtype = np.float32):
+    '''
+    .npy file backed output for TMM_solver_tiled, readable later with np.load(path, mmap_mode='r')
+    '''
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=tuple(shape))
+
+def _slice_freq(tensor, freq_slice):
+    # per-frequency tensors may also hold a single value for all frequencies
+    return tensor if tensor.size(-1) == 1 else tensor[..., freq_slice]
+
+class AngleAverage(object):
+    """Angle-averaged reflection sum_theta w R sin(2 theta) / sum_theta w sin(2 theta), with w the trapezoid
+    weights or the quadrature weights of theta (see quadrature.angle_grid), averaged over polarizations and
+    accumulated tile by tile. Same value as quadrature.hemispherical_reflection.
+
+    result: number of devices x number of frequencies
+    """
+    def __init__(self, theta, theta_weights = None):
+        theta = theta.detach().cpu().double()
+        if theta_weights is None:
+            theta_weights = torch.from_numpy(trapezoid_weights(theta.numpy()))
+        weights = theta_weights.detach().cpu().double() * torch.sin(2 * theta)
+        self.weights = weights / weights.sum()
+        self.total = None
+
+    def reset(self, shape, device, dtype):
+        self.total = torch.zeros(shape[:2], device=device, dtype=dtype)
+
+    def update(self, reflection, batch_slice, freq_slice, angle_slice):
+        weights = self.weights[angle_slice].to(device=reflection.device, dtype=reflection.dtype)
+        self.total[batch_slice, freq_slice] += torch.sum(reflection.mean(dim=3) * weights.view(1, 1, -1), dim=2)
+
+    def result(self):
+        return self.total
+
+class TargetFoM(object):
+    """Figure of merit mean((R - target)^2) over frequencies, angles and polarizations, as in the
+    notebooks, accumulated tile by tile.
+
+    Args:
+        target (tensor): 1 x number of frequencies x (number of angles or 1) x (number of pol or 1)
+
+    result: number of devices
+    """
+    def __init__(self, target):
+        self.target = target
+        self.total = None
+        self.count = 1
+
+    def reset(self, shape, device, dtype):
+        self.total = torch.zeros(shape[0], device=device, dtype=dtype)
+        self.count = shape[1] * shape[2] * shape[3]
+
+    def update(self, reflection, batch_slice, freq_slice, angle_slice):
+        target = self.target.to(device=reflection.device, dtype=reflection.dtype)
+        target = target[:, freq_slice] if target.size(1) > 1 else target
+        target = target[:, :, angle_slice] if target.size(2) > 1 else target
+        self.total[batch_slice] += torch.pow(reflection - target, 2).sum(dim=(1, 2, 3))
+
+    def result(self):
+        return self.total / self.count
+
+def TMM_solver_tiled(thicknesses, refractive_indices, n_bot, n_top, k, theta, pol = 'TM', memory_budget = 512 * 1024 ** 2,
+                     out = None, reductions = None, solver = TMM_solver_inference, precision = None):
+    '''
+    Evaluation-only TMM over devices x frequencies x angles tiles sized to memory_budget.
+    Every tile is solved without autograd, streamed into out and handed to the reductions,
+    so the full batch size x number of frequencies x number of angles x number of pol x 2 x 2
+    stack never exists at once. The workspaces of TMM_solver_inference are released at the end.
+
+    args:
+        thicknesses, refractive_indices, n_bot, n_top, k, theta, pol: as in TMM_solver
+        memory_budget (int): bytes allowed for the solve of one tile
+        out (ndarray, np.memmap or tensor): batch size x number of frequencies x number of angles x number of pol, optional
+        reductions (dict): name -> reduction with reset(shape, device, dtype), update(reflection, batch_slice, freq_slice, angle_slice)
+            and result(), e.g. AngleAverage or TargetFoM
+        solver: TMM_solver_inference (default), TMM_solver, TMM_solver_fused or TMM_solver_adjoint
+        precision (PrecisionPolicy): dtypes of the solve, DEFAULT_PRECISION if None
+
+    return:
+        out, {name: reduction result}
+    '''
+    precision = precision or DEFAULT_PRECISION
+    reductions = reductions or {}
+    batch_size = thicknesses.size(0)
+    numfreq = k.numel()
+    num_angles = theta.numel()
+    num_pol = 1 if pol in ['TM', 'TE'] else 2
+    devices, freqs, angles = plan_tiles(batch_size, numfreq, num_angles, num_pol, memory_budget, precision)
+    for reduction in reductions.values():
+        reduction.reset((batch_size, numfreq, num_angles, num_pol), thicknesses.device, precision.real_dtype)
+
+    with torch.no_grad():
+        for f0 in range(0, numfreq, freqs):
+            freq_slice = slice(f0, min(f0 + freqs, numfreq))
+            k_tile = k.view(-1)[freq_slice]
+            n_bot_tile = _slice_freq(n_bot.view(-1), freq_slice)
+            n_top_tile = _slice_freq(n_top.view(-1), freq_slice)
+            refractive_indices_tile = _slice_freq(refractive_indices, freq_slice)
+
+            for a0 in range(0, num_angles, angles):
+                angle_slice = slice(a0, min(a0 + angles, num_angles))
+                theta_tile = theta.view(-1)[angle_slice]
+                # tiles are visited once, so the context is built directly instead of going through the LRU cache
+                context = SolverContext(n_bot_tile, n_top_tile, k_tile, theta_tile, pol, precision)
+
+                for b0 in range(0, batch_size, devices):
+                    batch_slice = slice(b0, min(b0 + devices, batch_size))
+                    reflection = solver(thicknesses[batch_slice], refractive_indices_tile[batch_slice], n_bot_tile, n_top_tile,
+                                        k_tile, theta_tile, pol=pol, context=context)
+                    if out is not None:
+                        if torch.is_tensor(out):
+                            out[batch_slice, freq_slice, angle_slice].copy_(reflection)
+                        else:
+                            out[batch_slice, freq_slice, angle_slice] = reflection.cpu().numpy()
+                    for reduction in reductions.values():
+                        reduction.update(reflection, batch_slice, freq_slice, angle_slice)
+
+    # edge tiles have their own shapes, the pooled workspaces of all of them would outlive memory_budget
+    clear_workspaces()
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out, {name: reduction.result() for name, reduction in reductions.items()}
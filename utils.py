@@ -112,6 +112,19 @@ def save_checkpoint(state, checkpoint):
 
 
 
+def save_checkpoint_atomic(state, filepath):
+    """Saves state to filepath through a temporary file and an atomic rename, so that a reader
+    (or a crash mid-write) never sees a partially written checkpoint.
+    Args:
+        state: (dict) contains model's state_dict, may contain other keys such as iter, optimizer state_dict
+        filepath: (string) destination file, its folder is created if needed
+    """
+    os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+    tmp_path = filepath + '.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, filepath)
+
+
 def load_checkpoint(checkpoint, model, optimizer=None, scheduler=None):
     """Loads model parameters (state_dict) from file_path. If optimizer is provided, loads state_dict of
     optimizer assuming it is present in checkpoint.